@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+Сравнение поштучного shadowcast и пакетного shadowcast_batch на numpy
+в зависимости от числа существ. Запуск из корня репозитория:
+
+    python benchmarks/fov_batch.py [карта] [радиус]
+
+Печатает таблицу времён и точку, начиная с которой пакет выгоднее
+(её стоит держать в game_fov.FOV_BATCH_MIN).
+"""
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game_core import *
+
+def measure(func, repeat = 5):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def main():
+	if numpy is None:
+		exit("numpy не установлен, сравнивать не с чем")
+
+	map_name = sys.argv[1] if len(sys.argv) > 1 else "maps/1.txt"
+	view_dist = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+	rng = random.Random(1337)
+
+	room = Room(map_name)
+	free = [Position(x, y) for x in range(room.width) for y in range(room.height) \
+	        if room.passable(Position(x, y))]
+	grid = opacity_grid(room)
+	shadowcast_batch(room, free[:1], view_dist, grid) #прогрев таблиц
+
+	crossover = None
+	print("%8s %12s %12s %8s" % ("существ", "поштучно, мс", "пакетом, мс", "выигрыш"))
+	for count in (1, 2, 4, 8, 16, 32, 64, 128, 256):
+		positions = [rng.choice(free) for i in range(count)]
+		scalar = measure(lambda : [shadowcast(room, pos, view_dist) for pos in positions])
+		batch = measure(lambda : shadowcast_batch(room, positions, view_dist, grid))
+		if crossover is None and batch < scalar:
+			crossover = count
+		print("%8d %12.3f %12.3f %8.2f" % (count, scalar * 1000, batch * 1000, scalar / batch))
+
+	print()
+	print("пакет выгоднее начиная с %s существ" % crossover if crossover else "пакет не выгоднее ни разу")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Набор замеров горячих мест движка: обзор, поиск пути (с дверями и без),
+память существ, отрисовка, ход комнаты и расстановка объектов. Каждый
+замер гоняется на картах из maps/ и на сгенерированных этажах растущего
+размера и населённости, все случайности - от одного зерна. Запуск из
+любого места:
+
+    python benchmarks/suite.py [-o результаты.json] [-b база.json] [--quick]
+
+Результаты пишутся в JSON, и их же можно потом передать как базу через -b:
+тогда для каждого замера печатается, во сколько раз изменилась медиана,
+а если что-то замедлилось больше порога и при повторном замере, скрипт
+выходит с кодом 1.
+Сравнение поштучного и пакетного обзора - отдельно, в fov_batch.py.
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from game_levels import *
+
+SEED = 1337
+#один замер - сколько угодно вызовов подряд, но не короче этого (секунды),
+#иначе доли миллисекунды тонут в шуме таймера и планировщика
+MIN_SAMPLE = 0.1
+#сгенерированные этажи: (сторона, сколько багов)
+GENERATED = ((64, 8), (128, 32), (256, 128), (512, 512))
+GENERATED_QUICK = ((64, 8), (128, 32))
+
+def sample(func, setup, calls):
+	#как и timeit, сборщик мусора на время замера выключаем
+	elapsed = 0
+	gc.collect()
+	gc.disable()
+	try:
+		for i in range(calls):
+			arg = setup() if setup else None
+			start = time.perf_counter()
+			func(arg)
+			elapsed += time.perf_counter() - start
+	finally:
+		gc.enable()
+	return elapsed
+
+def measure(func, setup = None, repeat = 5):
+	"""
+	Лучшее и медианное время одного вызова func(setup()) в секундах, setup
+	в замер не входит. Как в timeit.autorange, число вызовов в замере
+	подбирается (1, 2, 5, 10, 20...), пока замер не станет дольше MIN_SAMPLE,
+	и время замера делится на число вызовов.
+	"""
+	calls = 1
+	while True:
+		for factor in (1, 2, 5):
+			if sample(func, setup, calls * factor) >= MIN_SAMPLE:
+				calls *= factor
+				break
+		else:
+			calls *= 10
+			continue
+		break
+	times = sorted(sample(func, setup, calls) / calls for i in range(repeat))
+	middle = len(times) // 2
+	return times[0], (times[middle] + times[-middle - 1]) / 2
+
+def free_tiles(room):
+	return [Position(i % room.width, i // room.width) for i in nonzero(room.pass_mask)]
+
+def text_room(name):
+	room = Room(MAPS_FOLDER + name)
+	if name in MAP_NAMES and MAP_NAMES.index(name) < len(OBJECTS):
+		load_objects(room, MAPS_FOLDER + OBJECTS[MAP_NAMES.index(name)])
+	return room
+
+def rooms(quick):
+	"""
+	Пары (имя, фабрика комнаты). Фабрика каждый раз строит комнату заново
+	с тем же зерном, чтобы замеры, которые меняют комнату, не влияли друг на друга.
+	"""
+	result = [(name, lambda name = name : text_room(name)) for name in MAP_NAMES]
+	for size, bugs in (GENERATED_QUICK if quick else GENERATED):
+		result.append(("office%d" % size, lambda size = size, bugs = bugs : \
+		               generate_office(size, size, seed = SEED, bugs = bugs)))
+	return result
+
+def populate(make, heroes):
+	"""
+	Свежая комната с тестерами-ботами у случайных свободных клеток, чтобы она
+	не спала. Общий генератор тоже сбрасывается: на нём кубики и левелапы,
+	и каждый повтор хода должен разыгрываться одинаково.
+	"""
+	random.seed(SEED)
+	rng = random.Random(SEED)
+	room = make()
+	free = free_tiles(room)
+	for i in range(heroes):
+		hero = Adventurer("Бот-%d" % (i + 1), level = 3)
+		hero.soul.control = bot_agent
+		hero.health = hero.health_max = 10 ** 6
+		pos = rng.choice(free)
+		if room.passable(pos):
+			hero._place(room, pos)
+	return room
+
+def bench_room(name, make, repeat, samples):
+	"""
+	Все замеры для одной комнаты: имя замера -> (лучшее, медиана, сколько операций).
+	"""
+	rng = random.Random(SEED)
+	room = make()
+	free = free_tiles(room)
+	positions = [rng.choice(free) for i in range(samples)]
+	results = {}
+
+	creature = Adventurer("Замерщик")
+	creature.room = room
+	def shadowcast(arg):
+		for pos in positions:
+			room.fov_cache.entries.clear()
+			creature.position = pos
+			creature._shadowcast()
+	results["shadowcast"] = measure(shadowcast, repeat = repeat) + (len(positions),)
+
+	for xp in (expand, expand_w_doors):
+		pairs = []
+		regions = room.door_regions if xp == expand_w_doors else room.regions
+		while len(pairs) < samples // 4:
+			a, b = rng.choice(free), rng.choice(free)
+			if a != b and regions.label(a) == regions.label(b):
+				pairs.append((a, b))
+		results["search_path/" + xp.__name__] = \
+			measure(lambda arg : [search_path(room, a, b, xp = xp) for a, b in pairs], repeat = repeat) + (len(pairs),)
+
+	views = [room.fov_cache.get(pos, creature.view_dist) for pos in positions]
+	results["memorize"] = measure(lambda soul : [soul.memorize(room, view) for view in views], \
+	                              setup = HumanSoul, repeat = repeat) + (len(views),)
+
+	viewer = Adventurer("Зритель")
+	viewer.room, viewer.position = room, positions[0]
+	viewer.visible_tiles = views[0][0]
+	#зритель помнит всё, что видел замерщик обзора, так что рисуется и память
+	for view in views:
+		viewer.soul.memorize(room, view)
+	results["vision"] = measure(lambda arg : viewer._get_vision(), repeat = repeat) + (1,)
+
+	ticks = 20
+	def ticking(room):
+		for i in range(ticks):
+			room.tick()
+	results["tick"] = measure(ticking, setup = lambda : populate(make, 3), \
+	                          repeat = repeat) + (ticks,)
+
+	return {kind + "/" + name : {"best_ms": best * 1000, "median_ms": median * 1000, "ops": ops} \
+	        for kind, (best, median, ops) in results.items()}
+
+def bench_load_objects(repeat):
+	name = MAP_NAMES[0]
+	result = measure(lambda room : load_objects(room, MAPS_FOLDER + OBJECTS[0]), \
+	                 setup = lambda : Room(MAPS_FOLDER + name), repeat = repeat)
+	return {"load_objects/" + name : {"best_ms": result[0] * 1000, "median_ms": result[1] * 1000, "ops": 1}}
+
+def compare(results, baseline, threshold):
+	"""
+	Печатает таблицу сравнения с базой по медианам, возвращает список
+	замедлившихся замеров.
+	"""
+	slower = []
+	print("%-40s %12s %12s %8s" % ("замер", "база, мс", "сейчас, мс", "x"))
+	for name in sorted(results):
+		if name not in baseline:
+			print("%-40s %12s %12.3f %8s" % (name, "-", results[name]["median_ms"], "новый"))
+			continue
+		old, new = baseline[name]["median_ms"], results[name]["median_ms"]
+		ratio = new / old if old else float("inf")
+		mark = ""
+		if ratio > 1 + threshold:
+			slower.append(name)
+			mark = " медленнее"
+		print("%-40s %12.3f %12.3f %8.2f%s" % (name, old, new, ratio, mark))
+	return slower
+
+def run(quick, repeat, only = None):
+	"""
+	Все замеры (или только для комнат из only) - словарь имя -> результат.
+	"""
+	random.seed(SEED)
+	results = {}
+	for name, make in rooms(quick):
+		if only is None or name in only:
+			print("замеряем", name, file = sys.stderr)
+			results.update(bench_room(name, make, repeat, 64))
+	if only is None or MAP_NAMES[0] in only:
+		results.update(bench_load_objects(repeat))
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description = "Замеры горячих мест движка.")
+	parser.add_argument("-o", "--output", help = "куда записать результаты в JSON")
+	parser.add_argument("-b", "--baseline", help = "JSON с прошлыми результатами для сравнения")
+	#на общих машинах медиана одного и того же кода гуляет до трети,
+	#так что порог по умолчанию ловит только заметные замедления
+	parser.add_argument("-t", "--threshold", type = float, default = 0.5, \
+	                    help = "на сколько (доля) можно замедлиться без ошибки, по умолчанию 0.5")
+	parser.add_argument("-r", "--repeat", type = int, default = 5, help = "повторов каждого замера")
+	parser.add_argument("--quick", action = "store_true", help = "только небольшие этажи")
+	args = parser.parse_args()
+
+	os.chdir(ROOT)
+	results = run(args.quick, args.repeat)
+
+	slower = []
+	if args.baseline:
+		f = open(args.baseline, "r", encoding = "utf-8")
+		baseline = json.load(f)["results"]
+		f.close()
+		slower = [name for name in results if name in baseline and \
+		          results[name]["median_ms"] > baseline[name]["median_ms"] * (1 + args.threshold)]
+		if slower:
+			#одиночный выброс замедлением не считаем: такие комнаты меряем ещё раз
+			#и берём лучшую из двух медиан
+			again = run(args.quick, args.repeat, set(name.split("/")[-1] for name in slower))
+			for name in slower:
+				if again[name]["median_ms"] < results[name]["median_ms"]:
+					results[name] = again[name]
+		slower = compare(results, baseline, args.threshold)
+	else:
+		for name in sorted(results):
+			print("%-40s %12.3f мс (x%d)" % (name, results[name]["median_ms"], results[name]["ops"]))
+
+	if args.output:
+		report = {"meta": {"python": platform.python_version(), "platform": platform.platform(), \
+		                   "numpy": numpy is not None, "seed": SEED, "repeat": args.repeat, "quick": args.quick}, \
+		          "results": results}
+		f = open(args.output, "w", encoding = "utf-8")
+		json.dump(report, f, indent = 1, sort_keys = True, ensure_ascii = False)
+		f.close()
+
+	if slower:
+		print()
+		print("замедлились:", ", ".join(slower))
+		exit(1)
+
+if __name__ == "__main__":
+	main()
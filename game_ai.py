@@ -2,51 +2,85 @@
 
 import os
 import time
+import heapq
+import itertools
+from collections import deque
 from game_utils import *
+from game_nav import *
 
+#сколько узлов может раскрыть один поиск пути, прежде чем сдаться
+SEARCH_BUDGET = 1000
 
 
-def search(start, goal, goal_test, eval_func, expand):
-
+def search(start, goal, goal_test, eval_func, expand, budget = None):
+	"""
+	A* на двоичной куче. При равной оценке первым достаётся узел, добавленный
+	раньше, поэтому пути получаются такими же, как при старой сортировке списка.
+	Закрытое множество хранит просто кортежи координат.
+	Если раскрыто budget узлов, а цель не найдена, возвращается узел,
+	ближе всех подобравшийся к цели по эвристике.
+	"""
 	start_node = Node(start)
-	fringe = [start_node]
-	expanded = set([])
+	counter = itertools.count()
+	fringe = [(eval_func(start_node), next(counter), start_node)]
+	closed = set()
+	depths = {(start.x, start.y): 0}
+	best, best_h = start_node, fringe[0][0]
 
 	while fringe:
-		fringe.sort(key = eval_func)
-		node = fringe.pop(0)
-		if node in expanded:
+		f, _, node = heapq.heappop(fringe)
+		key = (node.value.x, node.value.y)
+		if key in closed:
 			continue
 		if goal_test(node, goal):
 			return node
-		fringe += expand(node)
-		expanded.add(node)
+		if budget is not None and len(closed) >= budget:
+			return best
+		if f - node.depth < best_h:
+			best, best_h = node, f - node.depth
+		closed.add(key)
+		for child in expand(node):
+			child_key = (child.value.x, child.value.y)
+			#узел, уже найденный не длиннее, всё равно вытащится из кучи раньше
+			if child_key in closed or depths.get(child_key, child.depth + 1) <= child.depth:
+				continue
+			depths[child_key] = child.depth
+			heapq.heappush(fringe, (eval_func(child), next(counter), child))
 
 	return start_node
 
 def expand(room, node):
 
-	for dir_ in room.get_valid_directions(node.value):
-		pos = node.value + dir_
-		node.add_child(Node(pos))
-	return node.children
+	result = []
+	pos = node.value
+	width, height, passable = room.width, room.height, room.pass_mask
+	for dir_ in room.DIR_LIST:
+		x, y = pos.x + dir_.x, pos.y + dir_.y
+		if 0 <= x < width and 0 <= y < height and passable[y * width + x]:
+			result.append(Node(pos + dir_, node))
+	return result
 
 def expand_w_doors(room, node):
 
-	for dir_ in room.DIRECTIONS.values():
-		door = room.object_in_pos(node.value + dir_)
-		if door:
-			door = door.is_door
-		if room.passable(node.value + dir_) or door:
-			pos = node.value + dir_
-			node.add_child(Node(pos))
-	return node.children
+	result = []
+	pos = node.value
+	width, height, passable, doors = room.width, room.height, room.pass_mask, room.door_mask
+	for dir_ in room.DIR_LIST:
+		x, y = pos.x + dir_.x, pos.y + dir_.y
+		if 0 <= x < width and 0 <= y < height and (passable[y * width + x] or doors[y * width + x]):
+			result.append(Node(pos + dir_, node))
+	return result
 
 def search_path(room, start, goal, goal_test = lambda x,y : x.value.manhattan(y) == 1,\
-                xp = expand):
-
+                xp = expand, budget = None):
+	"""
+	Путь от start к goal списком позиций без start. budget - ограничение на
+	число раскрытых узлов (по умолчанию SEARCH_BUDGET), при его исчерпании
+	возвращается путь к самой многообещающей из найденных клеток.
+	"""
 	eval_func = lambda x : x.value.manhattan(goal) + x.depth
-	node = search(start, goal, goal_test, eval_func, lambda x : xp(room, x))
+	node = search(start, goal, goal_test, eval_func, lambda x : xp(room, x), \
+	              SEARCH_BUDGET if budget is None else budget)
 
 	result = []
 	while node.parent:
@@ -56,7 +90,57 @@ def search_path(room, start, goal, goal_test = lambda x,y : x.value.manhattan(y)
 
 	return result
 
-
+def search_nearest(room, start, targets, budget = None):
+	"""
+	Ищет ближайшую по реальному пути цель из targets (всё, у чего есть position)
+	одним обходом в ширину от start. Останавливается на первой клетке,
+	соседней с какой-нибудь целью. Возвращает (цель, путь без start) или
+	(None, []), если ни до одной цели не дойти. Цели из других связных
+	областей отбрасываются сразу, без обхода.
+	"""
+	label = room.regions.label(start)
+	goals = {}
+	for target in targets:
+		if label is None or room.regions.label(target.position) == label:
+			goals.setdefault((target.position.x, target.position.y), target)
+	if not goals:
+		return None, []
+
+	budget = SEARCH_BUDGET if budget is None else budget
+	parents = {(start.x, start.y): None}
+	fringe = deque([start])
+	while fringe and len(parents) <= budget:
+		pos = fringe.popleft()
+		for dir_ in room.DIR_LIST:
+			target = goals.get((pos.x + dir_.x, pos.y + dir_.y))
+			if target:
+				path = []
+				key = (pos.x, pos.y)
+				while parents[key]:
+					path.append(Position(*key))
+					key = parents[key]
+				path.reverse()
+				return target, path
+		for dir_ in room.get_valid_directions(pos):
+			step = pos + dir_
+			if (step.x, step.y) not in parents:
+				parents[(step.x, step.y)] = (pos.x, pos.y)
+				fringe.append(step)
+
+	return None, []
+
+
+
+def get_targets(agent, target_test = lambda x : x.faction == "testers"):
+	"""
+	Все подходящие цели. Видимые важнее: если видимых нет,
+	то шерстим память на наличие подходящих кандидатов.
+	"""
+	result = [unit for unit in agent._get_visible_units() if target_test(unit)]
+	if not result:
+		memory = agent.soul.recall(agent.room).units
+		result = [unit for unit in memory.values() if target_test(unit)]
+	return result
 
 def get_target(agent, target_test = lambda x : x.faction == "testers", \
                target_eval = lambda x : x.level):
@@ -65,21 +149,122 @@ def get_target(agent, target_test = lambda x : x.faction == "testers", \
 	то шерстим память на наличие подходящих кандидатов.
 	"""
 	target = None
-	visible_units = agent._get_visible_units()
-	for unit in visible_units:
-		if target_test(unit) and (not target or target_eval(unit) > target_eval(target)):
+	for unit in get_targets(agent, target_test):
+		if not target or target_eval(unit) > target_eval(target):
 			target = unit
 
-	if not target:
-		memory = agent.soul.recall(agent.room).units
-		for unit in memory.values():
-			if target_test(unit) and (not target or target_eval(unit) > target_eval(target)):
-				target = unit
-
 	return target
 
 
 
+def step_towards(agent, goal, radius = 1):
+	"""
+	Следующий шаг к клетке на расстоянии radius от goal. Берётся из общей
+	для комнаты карты расстояний, а если путь загораживают другие юниты
+	или агент дальше, чем строится карта, - ищется обычным search_path.
+	None, если идти некуда или уже пришли.
+	"""
+	dmap = agent.room.distance_maps.around(goal, radius)
+	dist = dmap.get(agent.position)
+	if dist == 0 or (dist is None and dmap.complete):
+		return None
+
+	step = dmap.next_step(agent.position)
+	if step:
+		return step
+
+	return follow_path(agent, goal, radius)
+
+def find_route(room, start, goal, radius = 1, xp = expand):
+	"""
+	Новый маршрут для follow_path. Если цель далеко, а агент умеет ходить
+	сквозь двери, путь сначала ищется по графу кластеров комнаты, и по клеткам
+	строится только отрезок до первого ориентира.
+	"""
+	kind = (xp, radius)
+	regions = room.door_regions if xp == expand_w_doors else room.regions
+	if not regions.reaches(start, ring(goal, radius)):
+		return Route([], goal, kind)
+
+	if xp == expand_w_doors and start.manhattan(goal) > 2 * room.clusters.size:
+		#до самой цели может не быть пути, а до клеток вокруг неё - быть,
+		#поэтому без ориентиров ищем как обычно
+		for waypoint in room.clusters.path((start.x, start.y), (goal.x, goal.y)):
+			waypoint = Position(*waypoint)
+			if waypoint == goal:
+				break
+			#на ориентире может стоять юнит (спящий баг - хоть вечно), а агент
+			#может уже стоять на нём самом - тогда идём к следующему
+			if room.unit_in_pos(waypoint):
+				continue
+			steps = search_path(room, start, waypoint, lambda x,y : x.value.manhattan(y) == 0, xp)
+			if steps:
+				return Route(steps, goal, kind, partial = True)
+
+	steps = search_path(room, start, goal, lambda x,y : x.value.manhattan(y) == radius, xp)
+	#поиск мог упереться в budget, тогда это только кусок пути
+	partial = bool(steps) and steps[-1].manhattan(goal) != radius
+	return Route(steps, goal, kind, partial = partial)
+
+def follow_path(agent, goal, radius = 1, xp = expand):
+	"""
+	Следующий шаг к клетке на расстоянии radius от goal по маршруту из кеша
+	комнаты. Маршрут пересчитывается, только если его выкинули из кеша, агента
+	куда-то сдвинуло или цель ушла далеко. Если цель сместилась на пару
+	клеток, маршрут достраивается от его конца.
+	"""
+	cache = agent.room.path_cache
+	goal_test = lambda x,y : x.value.manhattan(y) == radius
+	route = cache.get(agent, (xp, radius))
+
+	if route and route.steps and route.steps[0] == agent.position:
+		cache.advance(agent, route)
+	if route and route.steps and not route.steps[0].touch(agent.position):
+		route = None
+
+	fresh = False
+	if route and route.goal != goal:
+		end = route.steps[-1] if route.steps else agent.position
+		if route.partial:
+			route.goal = goal
+		elif route.goal.manhattan(goal) > 2:
+			route = None
+		elif end.manhattan(goal) != radius:
+			tail = search_path(agent.room, end, goal, goal_test, xp)
+			steps = list(route.steps)
+			for pos in tail:
+				#срезаем петли, чтобы не ходить туда-обратно
+				if pos in steps:
+					steps = steps[:steps.index(pos) + 1]
+				elif pos == agent.position:
+					steps = []
+				else:
+					steps.append(pos)
+			route = Route(steps, goal, (xp, radius)) if tail else None
+			fresh = True
+		else:
+			route.goal = goal
+
+	if route and not route.steps and agent.position.manhattan(goal) != radius:
+		route = None
+
+	if not route:
+		if agent.position.manhattan(goal) == radius:
+			cache.drop(agent)
+			return None
+		route = find_route(agent.room, agent.position, goal, radius, xp)
+		fresh = True
+
+	if not route.steps:
+		#неудачный поиск не кешируем: путь может открыться в любой момент
+		cache.drop(agent)
+	elif fresh:
+		cache.put(agent, route)
+
+	return route.steps[0] if route.steps else None
+
+
+
 def lazy_agent(agent):
 	"""
 	Самый ленивый в мире агент, который будет
@@ -121,22 +306,33 @@ def standing_agent(agent):
 def dumb_agent(agent):
 	"""
 	Туповатый агент. Используется для управления баженьками.
+	Идёт к ближайшей по реальному пути цели. Расстояния до целей берутся
+	из общих для комнаты карт расстояний, так что все баги, бегущие за одним
+	тестером, пользуются одной картой. Свой поиск (search_nearest) нужен,
+	только если карты шага не дают: проход загородили юниты или цель
+	дальше, чем строится карта.
 	"""
-	target = get_target(agent, target_eval = lambda x : -agent._get_mdist(x.position))
-
-	if target:
-
+	targets = get_targets(agent)
+	for target in targets:
 		if agent.position.touch(target.position):
 			agent.attack(target.position - agent.position)
 			return False
 
-		path = search_path(agent.room, agent.position, target.position)
+	step, best = None, None
+	for target in targets:
+		dmap = agent.room.distance_maps.around(target.position, 1)
+		dist = dmap.get(agent.position)
+		if dist is not None and (best is None or dist < best):
+			step, best = dmap.next_step(agent.position), dist
 
-		if path:
-			dir_ = path[0] - agent.position
-			agent.move(dir_)
-		else:
-			agent.wait()
+	if not step and targets:
+		target, path = search_nearest(agent.room, agent.position, targets)
+		step = path[0] if path else None
+
+	if step:
+		agent.move(step - agent.position)
+	elif targets:
+		agent.wait()
 	return False
 
 def summoned_agent(agent):
@@ -150,14 +346,12 @@ def summoned_agent(agent):
 		if agent.position.touch(target.position):
 			agent.attack(target.position - agent.position)
 			return False
-		path = search_path(agent.room, agent.position, target.position)
+		step = step_towards(agent, target.position)
 	else:
-		path = search_path(agent.room, agent.position, agent.master.position,\
-                           goal_test = lambda x,y: x.value.manhattan(y) in range(2,3))
+		step = step_towards(agent, agent.master.position, radius = 2)
 
-	if path:
-		dir_ = path[0] - agent.position
-		agent.move(dir_)
+	if step:
+		agent.move(step - agent.position)
 	else:
 		agent.wait()
 	return False
@@ -174,16 +368,14 @@ def owner_agent(agent):
 		if agent._get_mdist(target.position) <= 5 and agent._can_summon():
 			directions = agent.room.get_valid_directions(agent.position)
 			if directions:
-				dir_ = random.choice(directions)
+				dir_ = agent.rng.choice(directions)
 				agent.summon(dir_)
 				return False
 
-		path = search_path(agent.room, agent.position, target.position, \
-			goal_test = lambda x,y: x.value.manhattan(y) in range(3,4), \
-			xp = expand_w_doors)
-		if path:
-			dir_ = path[0] - agent.position
-			door = agent.room.object_in_pos(path[0])
+		step = follow_path(agent, target.position, radius = 3, xp = expand_w_doors)
+		if step:
+			dir_ = step - agent.position
+			door = agent.room.object_in_pos(step)
 			if door and door.is_door and door.closed:
 				agent.use(dir_)
 			else:
@@ -193,10 +385,204 @@ def owner_agent(agent):
 			return False
 		else:
 			agent.wait()
-	elif agent.room.items_in_pos(agent.position):
+	elif agent.room.items_at(agent.position):
 		agent.take()
 	return False
 
+def is_bug(unit):
+	return unit.faction == "bugs"
+
+def can_open(agent, door):
+	"""
+	Закрытая дверь, которую агент может открыть: она не заперта или ключ у него.
+	"""
+	return door.closed and (not door.key or any(item.name == door.key for item in agent.inventory))
+
+def locked_keys(agent, goal):
+	"""
+	Ключи, без которых agent не дойдёт до goal: пусто, если дойдёт, открывая
+	только те двери, что ему по силам. Связные области без дверей (room.regions)
+	склеиваются через каждую такую дверь, так что маршрут тут не нужен - он
+	всё равно мог бы оказаться частичным, до ориентира перед запертой дверью.
+	"""
+	room, regions = agent.room, agent.room.regions
+	start, end = regions.label(agent.position), regions.label(goal)
+	if start is None or end is None or start == end:
+		return set()
+
+	parent = {}
+	def root(label):
+		while parent.get(label, label) != label:
+			label = parent[label]
+		return label
+	keys = set()
+	for i in nonzero(room.door_mask):
+		door = room.objects[i]
+		if not door.closed:
+			continue
+		if not can_open(agent, door):
+			keys.add(door.key)
+			continue
+		pos = door.position
+		labels = [regions.label(pos + dir_) for dir_ in room.DIR_LIST if room.walkable(pos + dir_)]
+		for label in labels[1:]:
+			parent[root(label)] = root(labels[0])
+	return set() if root(start) == root(end) else keys
+
+#сколько ближайших спящих багов бот пробует найти, когда выход заперт
+BOT_HUNT_TRIES = 3
+#с какого расстояния до цели бот запускает автотест (тот бьёт на четыре клетки)
+BOT_AUTO_RANGE = 4
+
+def bot_detour(agent, keys):
+	"""
+	Шаг в обход запертой двери на пути к выходу: к одному из ключей keys - на
+	полу или у того, кто его подобрал (к такому вплотную, там бот его и побьёт,
+	а ключ выпадет), а если ключа не достать - к ближайшим багам, которых бот
+	не видит и не помнит (спящим). None, если идти некуда.
+	"""
+	room = agent.room
+	piles = [pos for pos, items in room.items.items() if any(item.name in keys for item in items)]
+	piles += [unit.position for unit in room.unit_queue \
+	          if unit is not agent and any(item.name in keys for item in unit.inventory)]
+	for pos in sorted(piles, key = agent._get_mdist):
+		step = follow_path(agent, pos, radius = 1 if room.unit_in_pos(pos) else 0, xp = expand_w_doors)
+		if step:
+			return step
+
+	bugs = sorted(room.unit_index.members("bugs"), key = lambda unit : agent._get_mdist(unit.position))
+	for bug in bugs[:BOT_HUNT_TRIES]:
+		step = follow_path(agent, bug.position, xp = expand_w_doors)
+		if step:
+			return step
+	return None
+
+def bot_station(agent, restores):
+	"""
+	Ближайший из запомненных ботом объектов, который ещё может восстановить
+	restores ("health" - игровая станция, "power" - кофе-машина).
+	"""
+	stations = [obj for obj in agent.soul.recall(agent.room).objects.values() \
+	            if getattr(obj, "restores", None) == restores and obj.cups > 0]
+	return min(stations, key = lambda obj : agent._get_mdist(obj.position)) if stations else None
+
+def bot_agent(agent):
+	"""
+	Тестер-бот для прогонов без игрока. Бьёт соседних багов, подбирает всё,
+	на чём стоит, раненым идёт лечиться (см. bot_station), а здоровым - к видимым
+	или запомненным багам, запуская по ним автотест, когда хватает энергии (за ней
+	тоже ходит к автомату), а если никого нет - к выходу на следующую карту,
+	открывая по пути двери. Если выход за запертой дверью, сначала идёт за
+	ключом или охотится на спящих багов (см. bot_detour). Уровни качает
+	случайно, как мобы.
+	"""
+	room = agent.room
+	bugs = [dir_ for dir_ in room.DIR_LIST if is_bug(room.unit_in_pos(agent.position + dir_) or agent)]
+	#призванных заказчик открывает заново, так что сперва бьём его самого,
+	#а если он за ними по диагонали - встаём к нему вплотную, как только есть куда
+	masters = set(getattr(room.unit_in_pos(agent.position + dir_), "master", None) for dir_ in bugs)
+	bugs.sort(key = lambda dir_ : room.unit_in_pos(agent.position + dir_) not in masters)
+	if bugs and room.unit_in_pos(agent.position + bugs[0]) not in masters:
+		for dir_ in room.DIR_LIST:
+			pos = agent.position + dir_
+			if room.passable(pos) and any(master and pos.touch(master.position) for master in masters):
+				agent.move(dir_)
+				return False
+	if bugs:
+		agent.attack(bugs[0])
+		return False
+
+	if room.items_at(agent.position):
+		agent.take()
+		return False
+
+	#у запомненных юнитов нет уровня, так что выбираем ближайшего
+	target = get_target(agent, target_test = is_bug, target_eval = lambda x : -agent._get_mdist(x.position))
+	auto = target and "auto" in agent.interface.keys(agent) and agent._can_summon()
+	if auto and agent.power >= 3 and agent._get_mdist(target.position) <= BOT_AUTO_RANGE:
+		#турель ставим так, чтобы цель оказалась с ней на одной линии: заказчик
+		#держится от тестера на расстоянии, и врукопашную его не догнать
+		for dir_ in room.get_valid_directions(agent.position):
+			diff = target.position - agent.position - dir_
+			if diff.x == 0 or diff.y == 0:
+				agent.auto(dir_)
+				return False
+
+	step = None
+	station = None
+	if agent.health * 2 <= agent.health_max:
+		station = bot_station(agent, "health")
+	elif auto and agent.power < 3:
+		station = bot_station(agent, "power")
+	if station:
+		if agent.position.touch(station.position):
+			agent.use(station.position - agent.position)
+			return False
+		step = follow_path(agent, station.position, xp = expand_w_doors)
+	elif target:
+		step = follow_path(agent, target.position, xp = expand_w_doors)
+	elif room.leave_point and room.next_room:
+		if agent.position == room.leave_point:
+			agent.enter()
+			return False
+		keys = locked_keys(agent, room.leave_point)
+		if keys:
+			step = bot_detour(agent, keys)
+		else:
+			step = follow_path(agent, room.leave_point, radius = 0, xp = expand_w_doors)
+
+	door = room.object_in_pos(step) if step else None
+	if door and door.is_door and door.closed:
+		if can_open(agent, door):
+			agent.use(step - agent.position)
+			return False
+	elif step:
+		agent.move(step - agent.position)
+		return False
+
+	#путь может загораживать кто-то за закрытой дверью, тогда сначала посмотрим, кто там
+	for dir_ in room.DIR_LIST:
+		door = room.object_in_pos(agent.position + dir_)
+		if door and door.is_door and can_open(agent, door):
+			agent.use(dir_)
+			return False
+
+	directions = room.get_valid_directions(agent.position)
+	if directions:
+		agent.move(agent.rng.choice(directions))
+	else:
+		agent.wait()
+	return False
+
+class ScriptedAgent(object):
+
+	"""
+	Контроллер, который берёт команды из строк - тех же, что игрок
+	вводит с клавиатуры ("move east", "item 0"), по одной на ход. Пустые
+	строки и строки с # пропускаются, непонятные команды тоже. Когда
+	команды кончаются, ходом управляет fallback (по умолчанию стоим).
+	commands может быть любым итерируемым, хоть бесконечным генератором:
+	строки достаются по мере надобности. Существо с таким контроллером можно
+	передать в другой процесс, только если итератор команд переносится
+	pickle (как у списка), а генератор - нет.
+	"""
+
+	def __init__(self, commands, fallback = lazy_agent):
+		self.commands = iter(commands)
+		self.fallback = fallback
+
+	def __call__(self, agent):
+		for line in self.commands:
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			query = line.split(" ")
+			command, args = query[0].lower(), [int(x) if x.isdigit() else x for x in query[1:]]
+			if command in agent.interface.keys(agent):
+				agent.interface.get(command, agent)(*args)
+				return False
+		return self.fallback(agent)
+
 def player_agent(agent):
 	"""
 	Агент, контролируемый игроком.
@@ -208,7 +594,7 @@ def player_agent(agent):
 		print(agent._get_vision())
 		print(agent.name)
 		print("Ур. %s, ПЗ: %s/%s, И: %s, Х: %s, Э: %s/%s, xp: %s   [%s, %s]" % agent._stats())
-		items = agent.room.items_in_pos(agent.position)
+		items = agent.room.items_at(agent.position)
 		print((("На полу лежит " + items[-1].name) if items else "") + (" и ещё что-то" if len(items) > 1 else ""))
 
 	draw_hud(agent)
@@ -226,7 +612,7 @@ def player_agent(agent):
 			agent.interface.get(command, agent)(*args)
 			break
 		elif command == "items":
-			floor_items = agent.room.items_in_pos(agent.position)
+			floor_items = agent.room.items_at(agent.position)
 
 			print("Инвентарь:")
 			if agent.inventory:
@@ -275,9 +661,11 @@ class Memory(object):
 	"""
 	Содержит память об определённой комнате.
 	Просто оболочка для трёх словарй для лучшей читаемости.
+	Стены и уже виденные клетки хранятся масками TileMask.
 	"""
 	def __init__(self):
-		self.walls = {}
+		self.walls = TileMask()
+		self.seen = TileMask()
 		self.units = {}
 		self.objects = {}
 
@@ -337,12 +725,26 @@ class HumanSoul(Soul):
 			self.memory[room.id] = Memory()
 
 		memory = self.memory[room.id]
-
-		for pos in data[0]:
-			#update() удалит из словаря ключ, если новое значение квалифицируется как False
-			update(memory.walls, pos, room[pos] == "#")
-			update(memory.objects, pos, room.object_in_pos(pos))
-			update(memory.units, pos, UnitMemory(room.unit_in_pos(pos)))
+		visible = data[0]
+
+		#стены не двигаются, так что их достаточно запомнить при первом взгляде
+		tiles, width = room.map, room.width
+		for x, y in (visible - memory.seen).cells():
+			if tiles[y * width + x] == WALL:
+				memory.walls.add(Position(x, y))
+		memory.seen = memory.seen | visible
+
+		#всё, что раньше было в поле зрения, но сейчас там пусто, забываем
+		for container in (memory.objects, memory.units):
+			for pos in [pos for pos in container if pos in visible]:
+				container.pop(pos)
+
+		for x, y in visible.cells():
+			obj, unit = room.objects[y * width + x], room.units[y * width + x]
+			if obj:
+				memory.objects[Position(x, y)] = obj
+			if unit:
+				memory.units[Position(x, y)] = UnitMemory(unit)
 
 	def recall(self, room):
 		return self.memory[room.id]
\ No newline at end of file
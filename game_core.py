@@ -1,10 +1,62 @@
 # -*- coding: utf-8 -*-
 
+import functools
 from game_ai import *
+from game_fov import *
 from game_utils import *
 from game_texts import *
 
+#существа дальше этого (по манхэттену) от всех тестеров и вне их обзора спят:
+#не смотрят по сторонам и не думают
+ACTIVITY_RADIUS = 10
+#сколько ходов не засыпает существо, которое только что ударили
+WAKE_TICKS = 5
+#ход комнаты в единицах времени очереди ходов. Существо со скоростью speed
+#ходит раз в TURN_TIME * TURN_TIME // speed единиц, обычная скорость - TURN_TIME
+TURN_TIME = 12
+#на сколько ходов вперёд откладывается ход уснувшего существа
+SLEEP_TURNS = 8
+
+#перевод байтов карты в маски рельефа: стена непроходима и непрозрачна
+#с какого числа клеток залитая комната хранится кусками (см. ChunkedArray)
+CHUNKED_ROOM_SIZE = 1 << 20
+
+WALKABLE_TILES = bytes(int(code != WALL) for code in range(256))
+OPAQUE_TILES = bytes(int(code == WALL) for code in range(256))
+
+def terrain_masks(tiles):
+	"""
+	Маски голого рельефа (без объектов) для байтов карты: (проходимость, непрозрачность).
+	"""
+	return tiles.translate(WALKABLE_TILES), tiles.translate(OPAQUE_TILES)
+
+def has_tick(obj):
+	"""
+	Есть ли у объекта поведение на каждом ходу, то есть переопределён ли _tick.
+	"""
+	return type(obj)._tick is not GameObject._tick
+
+def action(method):
+	"""
+	Действие существа, которое может вызвать контроллер. Пока существо
+	обдумывает ход на фазе решений двухфазного хода (intents не None),
+	действие не выполняется, а записывается в intents - комната выполнит
+	его позже, в очередь этого существа.
+	"""
+	@functools.wraps(method)
+	def wrapper(self, *args, **kwargs):
+		if self.intents is not None:
+			self.intents.append((method.__name__, args, kwargs))
+			return None
+		return method(self, *args, **kwargs)
+	return wrapper
 
+def can_auto(unit):
+	return unit.level >= 3
+
+#номера существ (Creature.uid). У рабочих процессов раннера свои диапазоны
+#(см. game_runner), так что номера не повторяются во всей кампании
+unit_ids = itertools.count()
 
 class GameObject(object):
 
@@ -32,6 +84,17 @@ class GameObject(object):
 	def _get_room(self):
 		return self.room
 
+	def __getstate__(self):
+		"""
+		Объект передаётся в другой процесс (см. game_runner) без комнаты:
+		комната остаётся в своём процессе, а на новом месте объект
+		разместят заново.
+		"""
+		state = self.__dict__.copy()
+		if "room" in state:
+			state["room"] = None
+		return state
+
 	def __log__(self, message, global_log = False):
 		if self._get_room():
 			self._get_room().log.append((self._get_position(), global_log, message))
@@ -45,6 +108,7 @@ class Creature(GameObject):
 
 	text_damaged = "повреждён"
 	text_dead = "уничтожен"
+	rng = random #на фазе решений у существа свой генератор, см. _plan()
 
 	def __init__(self, name, level = 0, opaque = False, passable = False, skin = "C",\
 		         soul = Soul, control = dumb_agent):
@@ -61,6 +125,7 @@ class Creature(GameObject):
 		self.level = 0
 		self.kill_count = 2**int(level)
 		self.faction = "neutral"
+		self.uid = next(unit_ids)
 		self.inventory = CreatureInventory(self)
 		self.summoned_creatures = set([])
 
@@ -71,15 +136,18 @@ class Creature(GameObject):
 		#положение в пространстве
 		self.room = None
 		self.position = Position(-1,-1)
-		self.shadowed_tiles = set([])
-		self.visible_tiles = set([])
+		self.shadowed_tiles = TileMask()
+		self.visible_tiles = TileMask()
 
 		#дед или андед :)
 		self.dead = False
 		self.undead = False
+		self.awake_until = 0 #до какого хода комнаты существо не засыпает
+		self.speed = TURN_TIME
 
 		#Искусственный Идиот
 		self.soul = soul(control = control)
+		self.intents = None #отложенные действия, пока существо думает, см. action()
 		self.interface = PredicateDict()
 		self.interface.set("move", self.move)
 		self.interface.set("wait", self.wait)
@@ -97,6 +165,7 @@ class Creature(GameObject):
 
 	#методы без нижнего подчёркивания доступны игроку
 	#напрямую через текстовые команды
+	@action
 	def attack(self, *args):
 		"""[west|north|east|south] - атаковать в заданном направлении"""
 		direction = process_direction(self.room, args)
@@ -114,10 +183,13 @@ class Creature(GameObject):
 		else:
 			self.__log__(self.name + ": тут никого нет!")
 
+	@action
 	def drop(self, *args, silent = False):
 		"""[номер] - бросить предмет на пол"""
 		index = args[0] if args and type(args[0]) == int else -1
-		item = self._shift_item(self.inventory, index, self.room.items_in_pos(self.position))
+		item = None
+		if self.inventory:
+			item = self._shift_item(self.inventory, index, self.room.items_in_pos(self.position))
 		if silent:
 			return
 		if item:
@@ -125,15 +197,17 @@ class Creature(GameObject):
 		else:
 			self.__log__(self.name + ": нечего выкидывать")
 
+	@action
 	def enter(self, *args):
 		"""- войти в переход на другую карту"""
 		if self.room[self.position] == ">" and self.room.next_room:
-			self._place(self.room.next_room, self.room.next_room.entry_point)
+			self.room.send(self, self.room.next_room, self.room.next_room.entry_point)
 		elif self.room[self.position] == "<" and self.room.prev_room:
-			self._place(self.room.prev_room, self.room.prev_room.leave_point)
+			self.room.send(self, self.room.prev_room, self.room.prev_room.leave_point)
 		else:
 			self.__log__(self.name + ": тут ничего нет.")
 
+	@action
 	def item(self, *args):
 		"""[номер] - использовать предмет из инвентаря"""
 		index = args[0] if args and type(args[0]) == int else -1
@@ -142,6 +216,7 @@ class Creature(GameObject):
 		else:
 			self.__log__(self.name + ": такого предмета нет")
 
+	@action
 	def move(self, *args):
 		"""[west|north|east|south] - двигаться в заданном направлении"""
 		direction = process_direction(self.room, args)
@@ -154,19 +229,22 @@ class Creature(GameObject):
 		else:
 			self.__log__(self.name + ": непонятное направление")
 
+	@action
 	def say(self, *args):
 		"""[text] - сказать что-нибудь"""
 		self.__log__(self.name + ": \"" + " ".join(args) + "\"")
 
+	@action
 	def take(self, *args):
 		"""[номер] - поднять предмет с пола"""
 		index = args[0] if args and type(args[0]) == int else -1
-		item = self._shift_item(self.room.items_in_pos(self.position), index, self.inventory)
+		item = self._shift_item(self.room.items_at(self.position), index, self.inventory)
 		if item:
 			self.__log__(self.name + " подбирает предмет: " + item.name)
 		else:
 			self.__log__(self.name + ": здесь ничего нет")
 
+	@action
 	def use(self, *args):
 		"""[west|north|east|south] - использовать объект"""
 		direction = process_direction(self.room, args)
@@ -180,34 +258,71 @@ class Creature(GameObject):
 		else:
 			self.__log__(self.name + ": непонятное направление")
 
+	@action
 	def wait(self, *args):
 		"""- пропустить ход"""
 		self.__log__(self.name + " стоит на месте.")
 
 	#методы с нижним подчёркиванием не доступны игроку
-	def _act(self):
+	def _act(self, dormant = False):
 		"""
 		Сделать свой ход. Вызывается при каждом проходе по списку юнитов.
 		Возвращает True, если контролируется игроком, это нужно для определения геймовера.
+		Спящее (dormant) существо не смотрит и не думает, только тикает.
 		"""
 		is_player = False
-		if not self.dead:
+		if not self.dead and dormant:
+			self._tick()
+		elif not self.dead:
 			self._observe()
 
 			is_player = self.soul.control(self)
-
-			while self.kill_count >= 2**(self.level + 1):
-				skills = set(self.interface.keys(self))
-				if not is_player:
-					self._level_up()
-				else:
-					self._level_up_by_player()
-				for skill in set(self.interface.keys(self)) - skills:
-					self.__log__(self.name + " получает новую способность: " + skill + "!")
-			self._tick()
+			self._end_turn(is_player)
 
 		return is_player
 
+	def _plan(self, seed):
+		"""
+		Фаза решений двухфазного хода: осмотреться и решить, что делать,
+		ничего не меняя в комнате. Возвращает список отложенных действий
+		для _carry_out(). Случайность берётся из своего генератора с зерном
+		seed, так что решение не зависит от того, в каком порядке думали
+		существа.
+		"""
+		self.intents = []
+		self.rng = random.Random(seed)
+		try:
+			self._observe()
+			self.soul.control(self)
+			return self.intents
+		finally:
+			self.intents = None
+			del self.rng
+
+	def _carry_out(self, intents):
+		"""
+		Фаза применения: выполнить решённое в _plan() уже в текущей комнате.
+		Если за это время существо умерло или его унесло в другую комнату,
+		решение устарело и пропадает. Конфликты решает сама комната: кто
+		раньше в очереди, тот и занял клетку, а опоздавший просто не пройдёт.
+		"""
+		if self.dead:
+			return
+		for name, args, kwargs in intents:
+			getattr(self, name)(*args, **kwargs)
+		self._end_turn(False)
+
+	def _end_turn(self, is_player):
+		while self.kill_count >= 2**(self.level + 1):
+			skills = set(self.interface.keys(self))
+			if not is_player:
+				self._level_up()
+			else:
+				self._level_up_by_player()
+			for skill in set(self.interface.keys(self)) - skills:
+				self.__log__(self.name + " получает новую способность: " + skill + "!")
+		self._tick()
+
 	def _can_see(self, target):
 		return target in self.visible_tiles
 
@@ -217,16 +332,51 @@ class Creature(GameObject):
 	def _get_inventory(self):
 		return self.inventory.copy()
 
+	def __getstate__(self):
+		state = GameObject.__getstate__(self)
+		#вызванные существа переезжают вместе с хозяином (см. Room.send), но
+		#отдельными юнитами, а хозяин запоминает только их номера и находит их
+		#уже в новой комнате, см. _resolve_summons()
+		#по дороге через родительский процесс существо передаётся дважды,
+		#и ещё не найденные номера тоже надо сохранить
+		uids = set(state.get("summoned_uids", ())) | set(unit.uid for unit in self.summoned_creatures)
+		state["summoned_creatures"] = set()
+		state["summoned_uids"] = sorted(uids)
+		return state
+
+	def _resolve_summons(self, room):
+		"""
+		Вызывается раннером, когда все приехавшие за ход юниты уже размещены
+		в комнате room: номера вызванных существ снова становятся существами.
+		"""
+		uids = self.__dict__.pop("summoned_uids", None)
+		if not uids:
+			return
+		units = dict((unit.uid, unit) for unit in room.unit_queue)
+		self.summoned_creatures = set(units[uid] for uid in uids if uid in units)
+
+	def _leave(self):
+		"""
+		Существо уходит из комнаты в другой процесс (см. Room.send).
+		"""
+		return
+
+	def _get_delay(self):
+		"""
+		Через сколько единиц времени очереди существо снова сходит.
+		"""
+		return max(1, TURN_TIME * TURN_TIME // self.speed)
+
 	def _get_mdist(self, pos):
 		return self.position.manhattan(pos)
 
-	def _get_visible_units(self):
-		result = []
-		for pos in self.visible_tiles:
-			unit = self.room.unit_in_pos(pos)
-			if unit:
-				result.append(unit)
-		return result
+	def _get_visible_units(self, faction = None):
+		"""
+		Видимые юниты по строкам, сверху вниз и слева направо. Раньше порядок
+		был порядком обхода множества видимых клеток, и при равных целях
+		get_target мог выбрать другую.
+		"""
+		return self.room.unit_index.in_mask(self.visible_tiles, faction)
 
 	def _get_vision(self):
 		"""
@@ -244,7 +394,7 @@ class Creature(GameObject):
 				if pos in self.visible_tiles:
 					unit = self.room.unit_in_pos(pos)
 					obj = self.room.object_in_pos(pos)
-					items = self.room.items_in_pos(pos)
+					items = self.room.items_at(pos)
 					item = items[-1] if items else None
 
 					if unit:
@@ -352,6 +502,8 @@ class Creature(GameObject):
 		else:
 			message += "промах!"
 		self.__log__(message)
+		self.awake_until = self.room.turn + WAKE_TICKS
+		self.room.wake(self)
 
 		if self.health <= 0:
 				self.__die__(other)
@@ -373,49 +525,10 @@ class Creature(GameObject):
 
 	def _shadowcast(self):
 		"""
-		Разделяем тайлы на видимые и затенённые. Основная идея скоммунизжена отсюда:
-		http://journal.stuffwithstuff.com/2015/09/07/what-the-hero-sees/
+		Разделяем тайлы на видимые и затенённые. Сам расчёт живёт в game_fov,
+		одинаковые запросы разных существ берутся из кеша комнаты.
 		"""
-		def tile_line(row, col):
-			n = col + row
-			d = 2 * row + 1
-			return [Rational(n, d), Rational(n + 1, d)]
-
-		result = (set([self.position]), set([]))
-		start = Position(0,0)
-		point = Position(0,0)
-
-		max_up = min(self.position.y, self.view_dist)
-		max_down = min(self.room.height - self.position.y - 1, self.view_dist)
-		max_left = min(self.position.x, self.view_dist)
-		max_right = min(self.room.width - self.position.x - 1, self.view_dist)
-
-		bounds = LoopedTuple((max_up, max_right, max_down, max_left))
-
-		for n in range(4):
-
-			shadowline = RealLine()
-			for point.x in range(1, min(bounds[n], self.view_dist) + 1):
-				current_shadowline = RealLine()
-				for point.y in range(max(-bounds[n+3], -point.x), min(bounds[n+1] + 1 ,point.x + 1)):
-
-					global_pos = translate(self.position, point, n)
-
-					if (start.dist(point) > self.view_dist):
-						continue
-
-					line = tile_line(point.x, point.y)
-					shadowed = shadowline.contains(line)
-					opaque = self.room.opaque(global_pos)
-
-					result[shadowed].add(global_pos)
-
-					if opaque:
-						current_shadowline.append(line)
-
-				shadowline.merge(current_shadowline)
-
-		return result
+		return self.room.fov_cache.get(self.position, self.view_dist)
 
 	def _shift_item(self, from_container, index, to_container):
 
@@ -507,12 +620,14 @@ class Adventurer(Creature):
 		self.faction = "testers"
 		self.interface.set("wait", self.wait)
 		self.interface.set("smoke", self.smoke)
-		self.interface.set("auto", self.auto, lambda x : x.level >= 3) # автотест даём только с 3-го уровня
+		self.interface.set("auto", self.auto, can_auto) # автотест даём только с 3-го уровня
 
+	@action
 	def wait(self, *args):
 		"""- тактическая прокрастинация. Пропускает ход."""
 		self.__log__(self.name + " прокрастинирует")
 
+	@action
 	def smoke(self, *args):
 		"""[west|north|east|south] - разместить заслоняющую обзор стену из трёх смоук-тестов. Стоит 1 энергии."""
 		if self.power < 1:
@@ -534,6 +649,7 @@ class Adventurer(Creature):
 		else:
 			self.__log__(self.name + ": непонятное направление")
 
+	@action
 	def auto(self, *args):
 		"""[west|north|east|south] - разместить на карте турель-автотест. Стоит 3 энергии."""
 
@@ -564,7 +680,8 @@ class AutoTest(Creature):
 		         skin = "^", soul = BugSoul, control = standing_agent):
 		Creature.__init__(self, name, level = level, soul = soul, control = control, skin = skin)
 		self.master = master
-		self.lifetime = 2 + round(master.level / 3)
+		self.lifetime = 2 + round(master.level / 3) #ходов до самоуничтожения
+		self.expiry = None #таймер самоуничтожения в колесе комнаты
 		self.intellect = master.intellect
 		self.cunning = master.cunning
 		self.power = 0
@@ -574,6 +691,7 @@ class AutoTest(Creature):
 		self.interface.set("attack", self.attack)
 		self.interface.set("wait", self.wait)
 
+	@action
 	def attack(self, *args):
 		"""[west|north|east|south] - очередь из трёх автотестов, стреляет на расстояние до четырёх тайлов."""
 		direction = process_direction(self.room, args)
@@ -581,15 +699,16 @@ class AutoTest(Creature):
 		attacks = 3
 		if direction:
 			self.__log__("Тра-та-та! " + self.name + " тестирует очередью!")
+			near = self.position + direction
+			far = Position(self.position.x + direction.x * dist, self.position.y + direction.y * dist)
 			for a in range(attacks):
-				position = Position(self.position.x, self.position.y)
-				for x in range(dist):
-					position += direction
-					unit = self.room.unit_in_pos(position)
-					if unit:
-						unit._receive_attack(*self.master.__atk__())
-						break
+				units = self.room.unit_index.in_rect(min(near.x, far.x), min(near.y, far.y), \
+				                                     max(near.x, far.x), max(near.y, far.y))
+				if units:
+					unit = min(units, key = lambda x : self._get_mdist(x.position))
+					unit._receive_attack(*self.master.__atk__())
 
+	@action
 	def wait(self):
 		return
 
@@ -601,12 +720,23 @@ class AutoTest(Creature):
 		self.health += 2
 		self.health_max += 2
 
-	def _tick(self):
-		Creature._tick(self)
-		self.lifetime -= 1
-		if self.lifetime <= 0:
+	def _expire(self):
+		if not self.dead:
 			self.__die__()
 
+	def _place(self, new_room, position):
+		Creature._place(self, new_room, position)
+		#срабатывает после хода комнаты, в котором автотест сходил lifetime-й раз
+		if self.expiry is None:
+			self.expiry = new_room.timers.schedule(self.lifetime + 1, self._expire)
+
+	def _leave(self):
+		#колесо таймеров остаётся в старой комнате, в новой таймер заводится
+		#заново на оставшиеся ходы (ход, в котором ушли, там уже не считается)
+		self.room.timers.cancel(self.expiry)
+		self.lifetime = max(0, self.expiry[0] - self.room.timers.now - 2)
+		self.expiry = None
+
 	def __killed__(self, victim):
 		self.master.__killed__(victim)
 
@@ -676,6 +806,7 @@ class Owner(Creature):
 		self.faction = "bugs"
 		self.interface.set("summon", self.summon)
 
+	@action
 	def summon(self, *args):
 		"""
 		[west|north|east|south] - открыть новый баг
@@ -778,6 +909,7 @@ class ItemTestGrenade(Item):
 			self.__log__("Содержимое коробки тикает и мигает красной лампочкой")
 			self.activator = user
 			self.lifetime = 6
+			user.room.timers.schedule(1, self._countdown)
 			if not ItemTestGrenade.exploded:
 				user.say("Я знал, что коробки - зло!")
 				ItemTestGrenade.name = "Бомба?"
@@ -785,8 +917,8 @@ class ItemTestGrenade(Item):
 		else:
 			user.__log__(user.name + ": оно тикает")
 
-	def _tick(self):
-		if not self.lifetime:
+	def _countdown(self):
+		if not self._get_room():
 			return
 
 		self.lifetime -= 1
@@ -799,14 +931,16 @@ class ItemTestGrenade(Item):
 				self.activator.say("Вот это бомбануло")
 			ItemTestGrenade.name = "Бомба"
 
+			room, center = self._get_room(), self._get_position()
+			units = room.unit_index.in_rect(center.x - 1, center.y - 1, center.x + 1, center.y + 1)
+			#по столбцам, как и раньше раздавался урон
+			for unit in sorted(units, key = lambda x : (x.position.x, x.position.y)):
+				unit._receive_attack(self.activator, 20, dice(4,10), True)
+
 			for pos in (Position(-1,-1), Position(-1,0), Position(-1,1),\
 				        Position( 0,-1), Position( 0,0), Position( 0,1),
 				        Position( 1,-1), Position( 1,0), Position( 1,1)):
 
-				unit = self._get_room().unit_in_pos(self._get_position() + pos)
-				if unit:
-					unit._receive_attack(self.activator, 20, dice(4,10), True)
-
 				#пока что закомментировано, чтобы не взорвать запертую дверь
 				"""
 				obj = self._get_room().object_in_pos(self._get_position() + pos)
@@ -820,6 +954,7 @@ class ItemTestGrenade(Item):
 			self.__die__()
 		else:
 			self.__log__(self.name + "...")
+			self._get_room().timers.schedule(1, self._countdown)
 
 
 
@@ -834,6 +969,7 @@ class Placeable(GameObject):
 		self.room = None
 		self.position = None
 		self.is_door = False
+		self.restores = None #"health" или "power": что восстанавливает _use(), пока есть cups
 
 	def _place(self, room, position):
 		if (room.passable(position) or (self.passable and room.unit_in_pos(position))) and \
@@ -868,6 +1004,7 @@ class Door(Placeable):
 			self.passable = False
 			self.opaque = True
 			self.closed = True
+			self.room.update_tile(self.position)
 		else:
 			user.__log__(user.name + " не может закрыть дверь прямо сейчас")
 
@@ -885,6 +1022,7 @@ class Door(Placeable):
 		self.passable = True
 		self.opaque = False
 		self.closed = False
+		self.room.update_tile(self.position)
 
 	def _use(self, user):
 		if self.closed:
@@ -901,12 +1039,11 @@ class Smoke(Placeable):
 	def __init__(self, opaque = True, skin = "*", lifetime = 4):
 		Placeable.__init__(self, opaque = opaque, passable = True, skin = skin)
 		self.lifetime = lifetime
-		self.count = 0
 
-	def _tick(self):
-		self.count += 1
-		if self.count >= self.lifetime:
-			self.__die__()
+	def _place(self, room, position):
+		Placeable._place(self, room, position)
+		if self.room:
+			room.timers.schedule(self.lifetime, self.__die__)
 
 class CoffeeMachine(Placeable):
 
@@ -918,6 +1055,7 @@ class CoffeeMachine(Placeable):
 		Placeable.__init__(self, opaque = opaque, passable = passable, skin = skin)
 		self.cups = 3
 		self.name = "Кофейный автомат"
+		self.restores = "power"
 
 	def _use(self, user):
 		if self.cups > 0:
@@ -938,6 +1076,7 @@ class GameMachine(Placeable):
 		Placeable.__init__(self, opaque = opaque, passable = passable, skin = skin)
 		self.cups = 3
 		self.name = "Игровая станция"
+		self.restores = "health"
 
 	def _use(self, user):
 		if self.cups > 0:
@@ -995,6 +1134,27 @@ class StaticInventory(Inventory):
 		self.room = room
 		self.position = position
 
+	def append(self, value):
+		Inventory.append(self, value)
+		self.room.items.setdefault(self.position, self)
+		if has_tick(value):
+			self.room.ticking_items[value] = None
+
+	def pop(self, index = None):
+		value = Inventory.pop(self, index)
+		self._forget(value)
+		return value
+
+	def remove(self, value):
+		Inventory.remove(self, value)
+		self._forget(value)
+
+	def _forget(self, value):
+		self.room.ticking_items.pop(value, None)
+		#пустые кучки на полу не храним
+		if not self.data and self.room.items.get(self.position) is self:
+			self.room.items.pop(self.position)
+
 	def copy(self):
 		cp = StaticInventory(self.room, self.position)
 		cp.data = self.data.copy()
@@ -1041,18 +1201,62 @@ class Room(object):
 
 	count = 0
 
-	def __init__(self, input_file = "", width = 50, height = 20):
+	def __init__(self, input_file = "", width = 50, height = 20, tiles = None, masks = None, \
+		         fill = None, chunked = None):
+		"""
+		Карта читается из текстового input_file, берётся готовой из tiles
+		(байты по строкам, width x height, так её отдаёт пак уровней),
+		заливается клеткой fill (дальше её вырезает генератор) или, если не
+		задано ничего, генерируется случайно. masks - уже посчитанные маски
+		рельефа (проходимость, непрозрачность) для tiles.
+		Залитая комната хранится кусками ChunkedArray, если она не меньше
+		CHUNKED_ROOM_SIZE клеток или если chunked задан явно, так что память
+		уходит только на куски, отличные от заливки.
+		"""
 		self.id = Room.count
 		Room.count += 1
-		self.map = []
+		self.map = bytearray() #клетки по строкам: индекс клетки (x, y) - y * width + x
+		self.source = input_file #файл карты, из которой комната собрана
 		self.items = {}
-		self.unit_queue = [] #нужен для сохранения очерёдности между ходами
+		#объекты и предметы на полу, которым нужен _tick(), в порядке появления.
+		#Словари вместо множеств - чтобы порядок тиков не зависел от хешей
+		self.ticking_objects = {}
+		self.ticking_items = {}
+		self.timers = TimerWheel() #всё, что живёт ограниченное число ходов
+		self.scheduler = Scheduler() #очередь ходов, она же хранит очерёдность между ходами
+		self.turn = 0 #номер хода комнаты
+		self.outbox = None #список уходящих в другие процессы юнитов, см. send()
+		self.two_phase = False #существа сначала все решают, потом по очереди действуют, см. _run_two_phase()
 		self.log = [] #тут логи, которые будем показывать каждый ход
 		self.entry_point = None #позиция входа на карту
 		self.leave_point = None #позиция выхода с карты
 		self.prev_room = None
 		self.next_room = None
-		if input_file:
+		self.terrain_version = 0 #растёт при каждом изменении проходимости рельефа
+		self.opacity_version = 0 #а это - при каждом изменении прозрачности
+		self.baked = Baked(self) #запечённые данные рядом с картой, читаются лениво
+		self.distance_maps = DistanceMaps(self)
+		self.path_cache = PathCache()
+		self.fov_cache = FovCache(self)
+		self.unit_index = SpatialIndex()
+		self.clusters = ClusterGraph(self)
+		self.regions = Regions(self)
+		self.door_regions = Regions(self, through_doors = True)
+		if tiles is not None:
+			self.width = width
+			self.height = height
+			self.map = bytearray(tiles)
+		elif fill is not None:
+			self.width = width
+			self.height = height
+			self.entry_point = Position(1,1)
+			if chunked is None:
+				chunked = width * height >= CHUNKED_ROOM_SIZE
+			if chunked:
+				self.map = ChunkedArray(width, height, ord(fill))
+			else:
+				self.map = bytearray([ord(fill)]) * (width * height)
+		elif input_file:
 			f = open(input_file, "r")
 			params = f.readline().split(" ")
 			self.width = int(params[0])
@@ -1060,30 +1264,53 @@ class Room(object):
 			if len(params) >= 5:
 				self.leave_point = Position(int(params[3]), int(params[4]))
 			self.height = 0
-			for i in range(self.width):
-				self.map.append([])
 			for line in f:
 				self.height += 1
 				for xpos in range(self.width):
-					self.map[xpos].append(line[xpos])
+					self.map.append(ord(line[xpos]))
 			f.close()
 		else:
 			self.width = width
 			self.height = height
 			self.entry_point = Position(1,1)
-			for x in range(self.width):	
-				self.map.append([])
+			self.map = bytearray(self.width * self.height)
+			for x in range(self.width):
 				for y in range(self.height):
-					self.map[-1].append(random.choice(("#", ".")))
-
-		self.units = [[None for y in range(self.height)] for x in range(self.width)]
-		self.objects = [[None for y in range(self.height)] for x in range(self.width)]
+					self.map[y * self.width + x] = ord(random.choice(("#", ".")))
+
+		#маски клеток, по байту на клетку, с той же индексацией, что и map.
+		#Их читают поиск пути и обзор, а поддерживает update_tile()
+		#walk_mask - проходимый рельеф: не стена и нет непроходимого объекта
+		#pass_mask - то же, и ещё никто не стоит
+		#opaque_mask - стена или непрозрачный объект
+		#door_mask - дверь, открытая или закрытая
+		size = self.width * self.height
+		if isinstance(self.map, ChunkedArray):
+			wall = self.map.fill == WALL
+			self.units = ChunkedArray(self.width, self.height, None, list)
+			self.objects = ChunkedArray(self.width, self.height, None, list)
+			self.walk_mask = ChunkedArray(self.width, self.height, int(not wall))
+			self.pass_mask = ChunkedArray(self.width, self.height, int(not wall))
+			self.opaque_mask = ChunkedArray(self.width, self.height, int(wall))
+			self.door_mask = ChunkedArray(self.width, self.height, 0)
+		else:
+			self.units = [None] * size
+			self.objects = [None] * size
+			self.walk_mask = bytearray(size)
+			self.pass_mask = bytearray(size)
+			self.opaque_mask = bytearray(size)
+			self.door_mask = bytearray(size)
+			if masks is None:
+				masks = terrain_masks(self.map)
+			self.walk_mask[:] = self.pass_mask[:] = masks[0]
+			self.opaque_mask[:] = masks[1]
 
 	def __getitem__(self, pos):
-		return self.map[pos.x][pos.y]
+		return chr(self.map[pos.y * self.width + pos.x])
 
 	def __setitem__(self, pos, value):
-		self.map[pos.x][pos.y] = value
+		self.map[pos.y * self.width + pos.x] = ord(value)
+		self.update_tile(pos)
 
 	def __str__(self):
 		result = ""
@@ -1092,14 +1319,14 @@ class Room(object):
 				pos = Position(x,y)
 				unit = self.unit_in_pos(pos)
 				obj = self.object_in_pos(pos)
-				items = self.items_in_pos(pos)
+				items = self.items_at(pos)
 
 				if unit:
 					result += unit.skin
 				elif obj:
 					result += obj.skin
 				elif items:
-					result += items[-1]
+					result += items[-1].skin
 				else:
 					result += self[pos]
 
@@ -1109,78 +1336,328 @@ class Room(object):
 
 	def get_valid_directions(self, pos):
 		result = []
+		width, height, mask = self.width, self.height, self.pass_mask
 		for dir_ in self.DIR_LIST:
-			if self.passable(pos + dir_) and self.in_bounds(pos + dir_):
+			x, y = pos.x + dir_.x, pos.y + dir_.y
+			if 0 <= x < width and 0 <= y < height and mask[y * width + x]:
 				result.append(dir_)
 		return result
 
 	def add(self, target):
-		self.units[target.position.x][target.position.y] = target
-		self.unit_queue.append(target)
+		i = target.position.y * self.width + target.position.x
+		self.units[i] = target
+		self.pass_mask[i] = 0
+		self.scheduler.add(target, (self.turn + 1) * TURN_TIME)
+		self.unit_index.add(target)
+		self.path_cache.block(target.position, target)
 
 	def remove(self, target):
-		self.units[target.position.x][target.position.y] = None
-		self.unit_queue.pop(self.unit_queue.index(target))
+		i = target.position.y * self.width + target.position.x
+		self.units[i] = None
+		self.pass_mask[i] = self.walk_mask[i]
+		self.scheduler.remove(target)
+		self.unit_index.remove(target)
+		self.path_cache.drop(target)
+
+	def send(self, unit, room, position):
+		"""
+		Переводит юнита в соседнюю комнату room на клетку position. Если
+		комнаты ходят в разных процессах (см. game_runner), тут есть outbox,
+		а room - только заглушка соседней комнаты: юнит покидает комнату
+		и ждёт в outbox, пока раннер не передаст его на границе хода.
+		Тогда с ним уходят и его вызванные существа.
+		"""
+		if self.outbox is None:
+			unit._place(room, position)
+			return
+		#вызванные существа уходят следом, иначе в старом процессе у них
+		#остался бы хозяин-копия, а новый хозяин мог бы вызвать ещё. Клетку
+		#им раннер подберёт рядом с хозяином (position = None)
+		summons = sorted((summon for summon in unit.summoned_creatures if summon.room is self), \
+		                 key = lambda summon : summon.uid)
+		for leaving, target in [(unit, position)] + [(summon, None) for summon in summons]:
+			leaving._leave()
+			self.remove(leaving)
+			leaving.room = None
+			self.outbox.append((leaving, room, target))
 
 	def move(self, target, pos):
 		if self.in_bounds(pos) and self.passable(pos):
-			self.units[target.position.x][target.position.y] = None
-			self.units[pos.x][pos.y] = target
+			i = target.position.y * self.width + target.position.x
+			self.units[i] = None
+			self.pass_mask[i] = self.walk_mask[i]
+			i = pos.y * self.width + pos.x
+			self.units[i] = target
+			self.pass_mask[i] = 0
 			target.position = pos
+			self.unit_index.move(target)
+			self.path_cache.block(pos, target)
 		else:
 			self.log.append(target.name + " не может идти туда!")
 
 	def passable(self, pos):
-		if not self.in_bounds(pos):
-			return False
-		unit = self.unit_in_pos(pos)
-		obj = self.object_in_pos(pos)
-		if obj:
-			obj = not obj.passable
-		return (self[pos] != "#") and not obj and not unit
+		return self.in_bounds(pos) and bool(self.pass_mask[pos.y * self.width + pos.x])
+
+	def nearest_free(self, pos):
+		"""
+		Ближайшая к pos свободная клетка, чтобы входящие в комнату
+		не телепортфрагали друг друга.
+		"""
+		for radius in range(self.width + self.height):
+			for x, y in ring(pos, radius):
+				if self.passable(Position(x, y)):
+					return Position(x, y)
+		return pos
 
 	def opaque(self, pos):
-		opaque_object = False
-		obj = self.object_in_pos(pos)
-		if obj:
-			opaque_object = obj.opaque
-		return self[pos] == "#" or opaque_object
+		return bool(self.opaque_mask[pos.y * self.width + pos.x])
+
+	def walkable(self, pos):
+		"""
+		Проходимость без учёта юнитов: стены и непроходимые объекты.
+		"""
+		return self.in_bounds(pos) and bool(self.walk_mask[pos.y * self.width + pos.x])
+
+	def update_tile(self, pos):
+		"""
+		Пересчитывает маски клетки pos по её рельефу и объекту. Вызывается
+		при каждом изменении клетки (поставили или убрали объект, открыли или
+		закрыли дверь). Если поменялась проходимость, растёт поколение рельефа
+		и сбрасываются маршруты через клетку, если прозрачность - поколение
+		прозрачности, так что устаревают закешированные результаты обзора.
+		"""
+		i = pos.y * self.width + pos.x
+		obj = self.objects[i]
+		wall = self.map[i] == WALL
+		walk = not wall and not (obj and not obj.passable)
+		door = bool(obj and obj.is_door)
+		opaque = wall or bool(obj and obj.opaque)
+
+		self.pass_mask[i] = walk and not self.units[i]
+		if self.walk_mask[i] != walk or self.door_mask[i] != door:
+			self.walk_mask[i] = walk
+			self.door_mask[i] = door
+			self.terrain_version += 1
+			self.clusters.invalidate(pos)
+			self.regions.invalidate(pos)
+			self.door_regions.invalidate(pos)
+			if not walk:
+				self.path_cache.block(pos)
+		if self.opaque_mask[i] != opaque:
+			self.opaque_mask[i] = opaque
+			self.opacity_version += 1
+
+	def fill_rect(self, x0, y0, x1, y1, tile):
+		"""
+		Заливает прямоугольник x0..x1, y0..y1 (включительно) клеткой tile.
+		То же, что room[pos] = tile для каждой клетки, но поколения и кластеры
+		обновляются один раз на весь прямоугольник. Нужно генератору карт.
+		"""
+		code = ord(tile)
+		wall = code == WALL
+		for y in range(y0, y1 + 1):
+			for x in range(x0, x1 + 1):
+				i = y * self.width + x
+				self.map[i] = code
+				obj = self.objects[i]
+				walk = not wall and not (obj and not obj.passable)
+				if self.walk_mask[i] and not walk:
+					self.path_cache.block(Position(x, y))
+				self.walk_mask[i] = walk
+				self.pass_mask[i] = walk and not self.units[i]
+				self.opaque_mask[i] = wall or bool(obj and obj.opaque)
+		self.terrain_version += 1
+		self.opacity_version += 1
+		self.regions.invalidate(None)
+		self.door_regions.invalidate(None)
+		for y in list(range(y0, y1 + 1, self.clusters.size)) + [y1]:
+			for x in list(range(x0, x1 + 1, self.clusters.size)) + [x1]:
+				self.clusters.invalidate(Position(x, y))
 
 	def in_bounds(self, pos):
 		return (pos.x >= 0 and pos.x < self.width) and (pos.y >= 0 and pos.y < self.height)
 
 	def wall_in_pos(self, pos):
-		return self[pos] == "#"
+		return self.map[pos.y * self.width + pos.x] == WALL
 
 	def unit_in_pos(self, pos):
-		return self.units[pos.x][pos.y]
+		if not self.in_bounds(pos):
+			return None
+		return self.units[pos.y * self.width + pos.x]
 
 	def object_in_pos(self, pos):
-		return self.objects[pos.x][pos.y]
+		if not self.in_bounds(pos):
+			return None
+		return self.objects[pos.y * self.width + pos.x]
 
 	def items_in_pos(self, pos):
-		if pos not in self.items:
-			self.items[pos] = StaticInventory(self, pos)
-		return self.items[pos]
+		"""
+		Кучка предметов в pos, куда можно класть. Заводится при первом
+		обращении, в Room.items попадает, только когда в неё что-то положат,
+		и пропадает оттуда, когда опустеет. Для чтения - items_at().
+		"""
+		items = self.items.get(pos)
+		if items is None:
+			items = StaticInventory(self, pos)
+		return items
+
+	def items_at(self, pos):
+		"""
+		Предметы на полу в pos только для чтения. Ничего не заводит:
+		если там пусто, возвращает пустой кортеж.
+		"""
+		return self.items.get(pos, ())
+
+	@property
+	def unit_queue(self):
+		"""
+		Юниты комнаты в порядке очереди ходов (только для чтения).
+		"""
+		return list(self.scheduler)
+
+	def awake_units(self):
+		"""
+		Существа, которые в этот ход не спят: тестеры и их автотесты, а также
+		все, кто ближе ACTIVITY_RADIUS к тестеру или попадает в его обзор.
+		Остальные спят, если давно не получали урона.
+		"""
+		awake = set()
+		for observer in self.unit_index.members("testers"):
+			awake.add(observer)
+			awake.update(self.unit_index.in_radius(observer.position, ACTIVITY_RADIUS))
+			awake.update(self.unit_index.in_mask(observer.visible_tiles))
+		return awake
+
+	def wake(self, unit):
+		"""
+		Спящее существо сходит уже на следующем ходу комнаты.
+		"""
+		self.scheduler.wake(unit, (self.turn + 1) * TURN_TIME)
 
 	def tick(self):
 		human_observer = False
-		#объекты могут самоуничтожаться, поэтому тут копируем
-		for unit in self.unit_queue.copy():
-			human_observer = unit._act() or human_observer
-
-		for x in range(self.width):
-			for y in range(self.height):
-				if self.objects[x][y]:
-					self.objects[x][y]._tick()
-
-		for floor_tile in self.items.values():
-			for item in floor_tile.copy():
-				item._tick()
+		self.turn += 1
+		self.distance_maps.sweep()
+		limit = self.turn * TURN_TIME
+
+		#спящих рядом с тестерами будим, остальных очередь не трогает
+		awake = self.awake_units()
+		for unit in awake:
+			self.scheduler.wake(unit, limit)
+		#не обходом очереди: она отдаёт юнитов отсортированными, спящих тоже
+		self.fov_cache.prefill(sorted((unit for unit in awake if unit in self.scheduler), \
+		                              key = lambda unit : unit.uid))
+
+		if self.two_phase:
+			human_observer = self._run_two_phase(limit, awake)
+		else:
+			unit, time = self.scheduler.pop(limit)
+			while unit:
+				dormant = unit not in awake and unit.awake_until <= self.turn
+				human_observer = unit._act(dormant) or human_observer
+				self._reschedule(unit, time, dormant)
+				unit, time = self.scheduler.pop(limit)
+
+		#объекты и предметы могут исчезать прямо во время тика
+		for obj in list(self.ticking_objects):
+			obj._tick()
+
+		self.timers.advance()
+
+		for item in list(self.ticking_items):
+			item._tick()
 		return human_observer
 
+	def _reschedule(self, unit, time, dormant):
+		#юнит мог умереть или уйти в другую комнату
+		if unit in self.scheduler:
+			self.scheduler.schedule(unit, time + (SLEEP_TURNS * TURN_TIME if dormant else unit._get_delay()))
+
+	def _run_two_phase(self, limit, awake):
+		"""
+		Ходы существ в два этапа. Сначала все, кому пора ходить, решают, что
+		делать, глядя на комнату, какой она была до начала этапа, и каждый со
+		своим генератором случайных чисел. Потом решения применяются по очереди
+		ходов. Игроки и спящие ходят как обычно, в свою очередь на втором этапе.
+		Быстрые существа, которым пора ходить ещё раз, попадают в следующий круг.
+		Режим нужен ради воспроизводимости: исход хода не зависит от того, в каком
+		порядке существа думали. Быстрее он не становится - ИИ на чистом питоне
+		держит GIL, а копировать комнату в другие процессы дороже самих решений.
+		"""
+		human_observer = False
+		while True:
+			batch = []
+			unit, time = self.scheduler.pop(limit)
+			while unit:
+				batch.append((unit, time, unit not in awake and unit.awake_until <= self.turn))
+				unit, time = self.scheduler.pop(limit)
+			if not batch:
+				return human_observer
+
+			#зерно круга берётся из общего генератора, так что ход воспроизводим
+			seed = random.getrandbits(32)
+			thinkers = [(unit, seed + i) for i, (unit, time, dormant) in enumerate(batch) \
+			            if not dormant and not unit.dead and unit.soul.control != player_agent]
+			plans = dict((unit, unit._plan(unit_seed)) for unit, unit_seed in thinkers)
+
+			for unit, time, dormant in batch:
+				if unit in plans:
+					#решение устарело, если существо уже не в этой комнате
+					if unit.room is self:
+						unit._carry_out(plans[unit])
+				else:
+					human_observer = unit._act(dormant) or human_observer
+				self._reschedule(unit, time, dormant)
+
+	def step(self):
+		"""
+		Ход комнаты в главном цикле. Полный ход делают только комнаты, где
+		есть тестеры или заведены таймеры, остальные ходят упрощённо, так что
+		цена хода кампании зависит от занятых комнат, а не от их числа.
+		"""
+		if self.timers or self.unit_index.count("testers"):
+			return self.tick()
+		return self.tick_abstract()
+
+	def tick_abstract(self):
+		"""
+		Упрощённый ход комнаты без наблюдателей: никто не смотрит по сторонам
+		и не думает, существа только доходят по уже проложенным маршрутам (они
+		могут быть грубыми, до ориентира на графе кластеров). У кого маршрута
+		в кеше нет (баги гоняются по картам расстояний, а не по маршрутам),
+		тот спит, как спящие в tick(): его ход откладывается на SLEEP_TURNS.
+		Как только в комнату войдёт тестер, она снова пойдёт полными ходами.
+		"""
+		self.turn += 1
+		self.distance_maps.sweep()
+		limit = self.turn * TURN_TIME
+		unit, time = self.scheduler.pop(limit)
+		while unit:
+			#маршрут в кеше начинается с клетки, на которую агент уже шагнул
+			route = self.path_cache.routes.get(unit)
+			if route and route.steps and route.steps[0] == unit.position:
+				self.path_cache.advance(unit, route)
+			walking = bool(route and route.steps)
+			if walking and route.steps[0].touch(unit.position) and self.passable(route.steps[0]):
+				self.move(unit, route.steps[0])
+			unit._tick()
+			self._reschedule(unit, time, not walking)
+			unit, time = self.scheduler.pop(limit)
+
+		for obj in list(self.ticking_objects):
+			obj._tick()
+
+		for item in list(self.ticking_items):
+			item._tick()
+		return False
+
 	def place_object(self, obj, position):
-		self.objects[position.x][position.y] = obj
+		self.objects[position.y * self.width + position.x] = obj
+		if has_tick(obj):
+			self.ticking_objects[obj] = None
+		self.update_tile(position)
 
 	def remove_object(self, obj):
-		self.objects[obj.position.x][obj.position.y] = None
\ No newline at end of file
+		self.objects[obj.position.y * self.width + obj.position.x] = None
+		self.ticking_objects.pop(obj, None)
+		self.update_tile(obj.position)
\ No newline at end of file
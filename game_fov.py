@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_right
+from collections import OrderedDict
+from game_utils import *
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+"""
+Поле зрения. Тот же shadowcasting, что и раньше (идея отсюда:
+http://journal.stuffwithstuff.com/2015/09/07/what-the-hero-sees/),
+только на целых числах и с заранее посчитанными таблицами.
+"""
+
+#перевод локальных (row, col) четверти n в смещение на карте, как в translate():
+#dx = xr * row + xc * col, dy = yr * row + yc * col
+QUADRANTS = ((0, 1, -1, 0), (1, 0, 0, 1), (0, -1, 1, 0), (-1, 0, 0, -1))
+
+class FovTable(object):
+
+	"""
+	Таблица тайлов четверти для одного радиуса обзора. Для каждого ряда
+	хранит (col, lo, hi) - колонку и угловой отрезок тайла. Отрезок
+	(col + row) / (2 * row + 1) .. (col + row + 1) / (2 * row + 1) домножен на
+	общий знаменатель всех рядов, поэтому сравнивать можно просто целые числа.
+	"""
+
+	def __init__(self, radius, rows = None):
+		self.radius = radius
+		scale = 1
+		for row in range(1, radius + 1):
+			scale = scale * (2 * row + 1) // math.gcd(scale, 2 * row + 1)
+		self.scale = scale
+
+		if rows is not None:
+			self.rows = rows
+			return
+
+		origin = Position(0, 0)
+		self.rows = []
+		for row in range(1, radius + 1):
+			k = scale // (2 * row + 1)
+			cells = []
+			for col in range(-row, row + 1):
+				if origin.dist(Position(row, col)) > radius:
+					continue
+				cells.append((col, (col + row) * k, (col + row + 1) * k))
+			self.rows.append(cells)
+
+FOV_TABLES = {}
+FOV_TABLE_FORMAT = 1 #поменять, если поменяется устройство FovTable.rows
+
+def fov_table(radius, room = None):
+	"""
+	Таблица радиуса radius. Если её ещё нет, сначала ищется среди
+	запечённых данных комнаты room.
+	"""
+	if radius not in FOV_TABLES:
+		rows = room.baked.get(("fov", radius), FOV_TABLE_FORMAT) if room else None
+		FOV_TABLES[radius] = FovTable(radius, rows)
+	return FOV_TABLES[radius]
+
+class ShadowLine(object):
+
+	"""
+	Объединение угловых отрезков тени. Отрезки не пересекаются и не касаются
+	друг друга и лежат по возрастанию, так что нужный ищется бинарным поиском.
+	"""
+
+	def __init__(self):
+		self.starts = []
+		self.ends = []
+
+	def covers(self, lo, hi):
+		i = bisect_right(self.starts, lo) - 1
+		return i >= 0 and self.ends[i] >= hi
+
+	def add(self, lo, hi):
+		starts, ends = self.starts, self.ends
+		i = bisect_right(starts, lo)
+		if i > 0 and ends[i - 1] >= lo:
+			i -= 1
+			lo = starts[i]
+			hi = max(hi, ends[i])
+			del starts[i], ends[i]
+		while i < len(starts) and starts[i] <= hi:
+			hi = max(hi, ends[i])
+			del starts[i], ends[i]
+		starts.insert(i, lo)
+		ends.insert(i, hi)
+
+def shadowcast(room, position, view_dist):
+	"""
+	Разделяем тайлы вокруг position на видимые и затенённые.
+	Возвращает пару TileMask (видимые, затенённые).
+	"""
+	table = fov_table(view_dist, room)
+	px, py = position.x, position.y
+	x0 = px - view_dist
+	visible, shadowed = {py : 1 << view_dist}, {}
+
+	bounds = (min(py, view_dist), min(room.width - px - 1, view_dist), \
+	          min(room.height - py - 1, view_dist), min(px, view_dist))
+
+	#прямой доступ к маске комнаты - это самое горячее место всего обзора
+	opaque, width = room.opaque_mask, room.width
+	for n in range(4):
+		xr, xc, yr, yc = QUADRANTS[n]
+		min_col, max_col = -bounds[(n + 3) % 4], bounds[(n + 1) % 4]
+		shadowline = ShadowLine()
+		starts, ends = shadowline.starts, shadowline.ends
+		for row in range(1, bounds[n] + 1):
+			opaque_cells = []
+			dx0, dy0 = xr * row, yr * row
+			for col, lo, hi in table.rows[row - 1]:
+				if col < min_col:
+					continue
+				if col > max_col:
+					break
+				dx, dy = dx0 + xc * col, dy0 + yc * col
+				x, y = px + dx, py + dy
+				#то же, что shadowline.covers(lo, hi), но без вызова метода
+				i = bisect_right(starts, lo) - 1
+				if i >= 0 and ends[i] >= hi:
+					shadowed[y] = shadowed.get(y, 0) | (1 << (dx + view_dist))
+				else:
+					visible[y] = visible.get(y, 0) | (1 << (dx + view_dist))
+				if opaque[y * width + x]:
+					opaque_cells.append((lo, hi))
+			for lo, hi in opaque_cells:
+				shadowline.add(lo, hi)
+
+			if starts == [0] and ends[0] >= table.scale:
+				#вся четверть уже в тени, дальше можно не проверять
+				for far_row in range(row + 1, bounds[n] + 1):
+					dx0, dy0 = xr * far_row, yr * far_row
+					for col, lo, hi in table.rows[far_row - 1]:
+						if min_col <= col <= max_col:
+							y = py + dy0 + yc * col
+							shadowed[y] = shadowed.get(y, 0) | (1 << (dx0 + xc * col + view_dist))
+				break
+
+	return TileMask(visible, x0), TileMask(shadowed, x0)
+
+#с какого числа существ в комнате пакетный расчёт на numpy выгоднее
+#поштучного (см. benchmarks/fov_batch.py)
+FOV_BATCH_MIN = 16
+
+class BatchTable(object):
+
+	"""
+	Таблица радиуса для пакетного расчёта. Все концы угловых отрезков сжаты
+	в отсортированный список E, ось наклонов разбита на ячейки: 2i - точка
+	E[i], 2i + 1 - интервал между E[i] и E[i + 1]. Тень - это булев вектор
+	покрытых ячеек, тайл в тени, если покрыты все его ячейки. Для касающихся
+	и пересекающихся отрезков это даёт ровно то же, что ShadowLine.
+	"""
+
+	def __init__(self, radius):
+		table = fov_table(radius)
+		self.radius = radius
+		self.side = 2 * radius + 1
+		ends = sorted(set(e for cells in table.rows for col, lo, hi in cells for e in (lo, hi)))
+		index = {e : i for i, e in enumerate(ends)}
+		self.width = 2 * len(ends) - 1
+
+		#для каждого ряда: смещения тайлов во всех четырёх четвертях (4 x C),
+		#ячейки тайлов и их номера в квадратном окне обзора
+		self.rows = []
+		for row, cells in enumerate(table.rows, 1):
+			dx = numpy.array([[xr * row + xc * col for col, lo, hi in cells] for xr, xc, yr, yc in QUADRANTS])
+			dy = numpy.array([[yr * row + yc * col for col, lo, hi in cells] for xr, xc, yr, yc in QUADRANTS])
+			first = numpy.array([2 * index[lo] for col, lo, hi in cells])
+			last = numpy.array([2 * index[hi] for col, lo, hi in cells])
+			span = numpy.zeros((len(cells), self.width), dtype = numpy.int32)
+			for i in range(len(cells)):
+				span[i, first[i]:last[i] + 1] = 1
+			window = (dy + radius) * self.side + dx + radius
+			self.rows.append((dx, dy, first, last, span, window))
+
+BATCH_TABLES = {}
+
+def batch_table(radius):
+	if radius not in BATCH_TABLES:
+		BATCH_TABLES[radius] = BatchTable(radius)
+	return BATCH_TABLES[radius]
+
+def opacity_grid(room):
+	"""
+	Непрозрачность комнаты массивом numpy [y, x].
+	"""
+	grid = numpy.frombuffer(room.opaque_mask, dtype = numpy.uint8)
+	return grid.reshape(room.height, room.width).astype(bool)
+
+def shadowcast_batch(room, positions, view_dist, grid = None):
+	"""
+	Тот же shadowcast, но сразу для многих позиций: существа идут по оси
+	массива, ряды четверти - по очереди. Возвращает список пар TileMask
+	в порядке positions. Нужен numpy.
+	"""
+	table = batch_table(view_dist)
+	if grid is None:
+		grid = opacity_grid(room)
+	count = len(positions)
+	area = table.side * table.side
+	px = numpy.array([pos.x for pos in positions])[:, None, None]
+	py = numpy.array([pos.y for pos in positions])[:, None, None]
+	quadrant = numpy.arange(4)[:, None]
+
+	#оси: существо, четверть, тайл ряда (или ячейка оси наклонов)
+	visible = numpy.zeros((count, 4, area), dtype = bool)
+	shadowed = numpy.zeros((count, 4, area), dtype = bool)
+	shadow = numpy.zeros((count, 4, table.width), dtype = numpy.int32)
+	covered = numpy.zeros((count, 4, table.width + 1), dtype = numpy.int32)
+
+	for dx, dy, first, last, span, window in table.rows:
+		x, y = px + dx, py + dy
+		inside = (x >= 0) & (x < room.width) & (y >= 0) & (y < room.height)
+		numpy.cumsum(shadow > 0, axis = 2, out = covered[:, :, 1:])
+		dark = covered[:, :, last + 1] - covered[:, :, first] == last - first + 1
+		visible[:, quadrant, window] = inside & ~dark
+		shadowed[:, quadrant, window] = inside & dark
+		opaque = inside & grid[numpy.clip(y, 0, room.height - 1), numpy.clip(x, 0, room.width - 1)]
+		shadow += opaque.astype(numpy.int32) @ span
+
+	visible = visible.any(axis = 1)
+	shadowed = shadowed.any(axis = 1)
+	visible[:, view_dist * table.side + view_dist] = True
+
+	#каждый ряд окна превращаем в одно целое число - готовый ряд TileMask
+	side = table.side
+	weights = numpy.left_shift(1, numpy.arange(side, dtype = numpy.uint64), dtype = numpy.uint64)
+	masks = []
+	for window in (visible, shadowed):
+		if side < 64:
+			rows = (window.reshape(count, side, side).astype(numpy.uint64) @ weights).tolist()
+		else:
+			bits = numpy.packbits(window.reshape(count, side, side), axis = 2, bitorder = "little")
+			rows = [[int.from_bytes(row.tobytes(), "little") for row in creature] for creature in bits]
+		masks.append(rows)
+
+	result = []
+	for pos, visible_rows, shadowed_rows in zip(positions, *masks):
+		y0, x0 = pos.y - view_dist, pos.x - view_dist
+		result.append((TileMask({y0 + j : row for j, row in enumerate(visible_rows) if row}, x0), \
+		               TileMask({y0 + j : row for j, row in enumerate(shadowed_rows) if row}, x0)))
+	return result
+
+#сколько обзоров держит FovCache комнаты. Существа стоят на месте или
+#ходят рядом, так что и тысячам существ хватает, а давно не нужные
+#записи (ушли, умерли) вытесняются
+FOV_CACHE_SIZE = 4096
+
+class FovCache(object):
+
+	"""
+	Общий для всех существ комнаты кеш обзора (Room.fov_cache), живёт и
+	умирает вместе с комнатой. Ключ - (позиция, радиус), записи верны для
+	одного поколения непрозрачности комнаты. Поколение растёт, когда
+	открывается или закрывается дверь, ставится или пропадает дым, и тогда
+	старые записи выкидываются разом. Пока поколение не меняется, хранится
+	не больше size записей, лишние вытесняются по давности использования (LRU).
+	Результаты общие, их маски менять нельзя.
+	"""
+
+	def __init__(self, room, size = FOV_CACHE_SIZE):
+		self.room = room
+		self.size = size
+		self.version = None
+		self.entries = OrderedDict()
+
+	def _entries(self):
+		if self.version != self.room.opacity_version:
+			self.entries = OrderedDict()
+			self.version = self.room.opacity_version
+		return self.entries
+
+	def _store(self, entries, key, result):
+		entries[key] = result
+		while len(entries) > self.size:
+			entries.popitem(last = False)
+
+	def get(self, position, view_dist):
+		key = (position.x, position.y, view_dist)
+		entries = self._entries()
+		result = entries.get(key)
+		if result is not None:
+			entries.move_to_end(key)
+			return result
+
+		result = shadowcast(self.room, position, view_dist)
+		self._store(entries, key, result)
+		return result
+
+	def prefill(self, creatures):
+		"""
+		Заранее считает обзор всех существ комнаты одним пакетом на numpy,
+		если numpy есть и существ достаточно много. Потом каждое существо
+		просто достаёт свой кусок из кеша.
+		"""
+		room = self.room
+		#кусочную комнату пакет пришлось бы сначала развернуть целиком
+		if numpy is None or isinstance(room.opaque_mask, ChunkedArray):
+			return
+		entries = self._entries()
+
+		by_radius = {}
+		for creature in creatures:
+			key = (creature.position.x, creature.position.y, creature.view_dist)
+			if key not in entries:
+				by_radius.setdefault(creature.view_dist, {})[key] = creature.position
+
+		grid = None
+		for view_dist, missing in by_radius.items():
+			if len(missing) < FOV_BATCH_MIN:
+				continue
+			if grid is None:
+				grid = opacity_grid(room)
+			positions = list(missing.values())
+			results = shadowcast_batch(room, positions, view_dist, grid)
+			for key, result in zip(missing, results):
+				self._store(entries, key, result)
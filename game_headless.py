@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+import argparse
+from game_runner import *
+from game_levels import *
+
+"""
+Игра без экрана и клавиатуры: те же карты, что и в game.py, но вместо
+игрока тестерами управляют боты (bot_agent) или команды из файла
+(ScriptedAgent). Комнаты ходят так быстро, как могут, без отрисовки,
+а в конце печатается скорость в ходах в секунду и итоговое состояние.
+На этом построены все нагрузочные прогоны.
+"""
+
+def room_report(room):
+	"""
+	Итог по комнате: номер хода, сколько юнитов каждой фракции
+	и статы тестеров-приключенцев, как их видит игрок в HUD.
+	"""
+	units = {}
+	for unit in room.unit_queue:
+		units[unit.faction] = units.get(unit.faction, 0) + 1
+	testers = [(unit.name,) + unit._stats() for unit in room.unit_index.members("testers") \
+	           if isinstance(unit, Adventurer)]
+	return {"turn": room.turn, "units": units, "testers": testers}
+
+def run(ticks, controls = (bot_agent,), rooms = None, processes = False, two_phase = False):
+	"""
+	Прогоняет ticks ходов кампании rooms (по умолчанию - из maps/) с одним
+	тестером на каждый контроллер из controls. Возвращает словарь со
+	временем, скоростью и итогом по каждой комнате (см. room_report).
+	processes - каждая комната в своём процессе (см. RoomRunner),
+	two_phase - двухфазный ход комнат (см. Room.two_phase).
+	"""
+	rooms = rooms or load_campaign()
+	for i, control in enumerate(controls):
+		hero = Adventurer("Бот-%d" % (i + 1), level = 0)
+		hero.soul.control = control
+		hero._place(rooms[0], rooms[0].nearest_free(rooms[0].entry_point))
+	for room in rooms:
+		room.two_phase = two_phase
+
+	runner = RoomRunner(rooms, processes = processes)
+	try:
+		start = time.perf_counter()
+		for tick in range(ticks):
+			runner.step()
+		elapsed = time.perf_counter() - start
+		report = [runner.call(i, room_report) for i in range(len(rooms))]
+	finally:
+		runner.close()
+
+	return {"ticks": ticks, "seconds": elapsed, "tps": ticks / elapsed if elapsed else float("inf"), \
+	        "rooms": report}
+
+def print_report(result, names = MAP_NAMES):
+	print("%d ходов за %.2f с: %.1f ходов/с" % (result["ticks"], result["seconds"], result["tps"]))
+	for i, room in enumerate(result["rooms"]):
+		name = names[i] if i < len(names) else str(i)
+		units = ", ".join("%s: %d" % item for item in sorted(room["units"].items())) or "пусто"
+		print("%s (ход %d) - %s" % (name, room["turn"], units))
+		for tester in room["testers"]:
+			print("  %s: ур. %s, ПЗ: %s/%s, И: %s, Х: %s, Э: %s/%s, xp: %s   [%s, %s]" % tester)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Прогон кампании без экрана и клавиатуры.")
+	parser.add_argument("-n", "--ticks", type = int, default = 1000, help = "сколько ходов прогнать")
+	parser.add_argument("-b", "--bots", type = int, default = 1, help = "сколько тестеров-ботов")
+	parser.add_argument("-c", "--commands", help = "файл с командами для тестера, по одной на ход")
+	parser.add_argument("-s", "--seed", type = int, help = "зерно генератора случайных чисел")
+	parser.add_argument("--two-phase", action = "store_true", help = "двухфазный ход комнат")
+	parser.add_argument("--processes", action = "store_true", help = "каждая комната в своём процессе")
+	args = parser.parse_args()
+
+	if args.seed is not None:
+		random.seed(args.seed)
+	controls = [bot_agent] * args.bots
+	if args.commands:
+		f = open(args.commands, "r", encoding = "utf-8")
+		#после конца сценария тестер доигрывает сам
+		controls = [ScriptedAgent(f.readlines(), fallback = bot_agent)] + controls[1:]
+		f.close()
+
+	print_report(run(args.ticks, controls, processes = args.processes, two_phase = args.two_phase))
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import random
+import mmap
+import struct
+from game_core import *
+
+"""
+Загрузка уровней. Исходники уровней - текстовые карты и списки объектов
+в maps/, из них собирается бинарный пак кампании: все карты, маски рельефа
+и таблица объектов в одном файле, который при запуске просто отображается
+в память, без разбора текста.
+"""
+
+OBJ_TYPES = {"COFFEE": CoffeeMachine,
+             "GAME": GameMachine,
+             "DOOR": Door,
+             "BUG": Bug,
+             "OWNER": Owner,
+             "ITEM": Item,
+             "FOO": ItemFooBar,
+             "BOOK": ItemBook,
+             "GRENADE": ItemTestGrenade}
+
+MAPS_FOLDER = "./maps/"
+MAP_NAMES = ("1.txt", "2.txt", "test_area.txt")
+OBJECTS = ("1_objects.txt",)
+PACK_NAME = "campaign.pack"
+
+def spawn(room, name, x, y, args):
+	OBJ_TYPES[name](*args)._place(room, Position(int(x),int(y)))
+
+def read_objects(filename):
+	"""
+	Таблица объектов из текстового файла: список (имя, x, y, аргументы).
+	"""
+	result = []
+	f = open(filename, "r", encoding="utf-8")
+	for line in f:
+		name, x, y, *args = line[:-1].split(";")
+		result.append((name, int(x), int(y), args))
+	f.close()
+	return result
+
+def load_objects(room, filename):
+	for name, x, y, args in read_objects(filename):
+		spawn(room, name, x, y, args)
+
+def link_rooms(rooms):
+	for i in range(len(rooms) - 1):
+		rooms[i].next_room = rooms[i+1]
+		rooms[i+1].prev_room = rooms[i]
+	return rooms
+
+def load_text_campaign(folder = MAPS_FOLDER, names = MAP_NAMES, objects = OBJECTS):
+	rooms = [Room(folder + name) for name in names]
+	for i in range(len(objects)):
+		load_objects(rooms[i], folder + objects[i])
+	return link_rooms(rooms)
+
+def generate_office(width, height, seed = None, density = 0.6, bugs = 0, block = 16):
+	"""
+	Процедурный этаж офиса для нагрузочных прогонов. Этаж режется на
+	квадраты block x block, кабинетами занимается доля density из них:
+	от левого верхнего квадрата случайно прирастают соседние, каждый новый
+	кабинет соединяется коридором (иногда с дверью) с тем, от которого
+	прирос, так что все кабинеты связны.
+	Остальное - сплошная стена, поэтому большие этажи хранятся кусками
+	и занимают память по площади кабинетов. bugs - сколько багов расставить.
+	"""
+	rng = random.Random(seed)
+	room = Room(width = width, height = height, fill = "#")
+	cols, rows = max(1, (width - 2) // block), max(1, (height - 2) // block)
+
+	def office(bx, by):
+		x0, y0 = 1 + bx * block, 1 + by * block
+		w = rng.randint(block // 3, block - 3)
+		h = rng.randint(block // 3, block - 3)
+		x = rng.randint(x0 + 1, x0 + block - w - 1)
+		y = rng.randint(y0 + 1, y0 + block - h - 1)
+		room.fill_rect(x, y, min(x + w - 1, width - 2), min(y + h - 1, height - 2), ".")
+		return Position(x + w // 2, y + h // 2)
+
+	def frontier_of(square):
+		bx, by = square
+		return [(square, (bx + dx, by + dy)) for dx, dy in ((1,0), (-1,0), (0,1), (0,-1)) \
+		        if 0 <= bx + dx < cols and 0 <= by + dy < rows]
+
+	doors = []
+	centers = {(0, 0): office(0, 0)}
+	frontier = frontier_of((0, 0))
+	target = max(1, round(cols * rows * density))
+	while frontier and len(centers) < target:
+		parent, square = frontier.pop(rng.randrange(len(frontier)))
+		if square in centers:
+			continue
+		centers[square] = office(*square)
+		a, b = centers[parent], centers[square]
+		#коридор буквой Г: сначала по горизонтали, потом по вертикали
+		room.fill_rect(min(a.x, b.x), a.y, max(a.x, b.x), a.y, ".")
+		room.fill_rect(b.x, min(a.y, b.y), b.x, max(a.y, b.y), ".")
+		if rng.random() < 0.3:
+			doors.append(Position((a.x + b.x) // 2, a.y))
+		frontier += frontier_of(square)
+
+	for pos in doors:
+		#дверь ставим только в узком месте коридора, не посреди кабинета
+		if not room.walkable(pos + Position(0, -1)) and not room.walkable(pos + Position(0, 1)):
+			Door()._place(room, pos)
+
+	room.entry_point = centers[(0, 0)]
+	spots = list(centers.values())[1:]
+	for i in range(min(bugs, len(spots))):
+		Bug()._place(room, spots[i])
+	return room
+
+"""
+Формат пака (всё little-endian):
+  заголовок PACK_HEADER: сигнатура, версия формата, число карт;
+  по записи PACK_ROOM на карту: размеры, вход и выход (-1, если выхода нет),
+  смещения имени, клеток и таблицы объектов, длина имени и число объектов;
+  данные карт: имя в utf-8, затем клетки, маска проходимости и маска
+  непрозрачности - по width * height байт, по строкам, как в Room.map;
+  таблица объектов: PACK_SPAWN (x, y, длина текста) и текст
+  "ИМЯ;арг1;арг2" в utf-8.
+"""
+PACK_MAGIC = b"RTLP"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<4sHH")
+PACK_ROOM = struct.Struct("<HHhhhhIIIHH")
+PACK_SPAWN = struct.Struct("<HHH")
+
+def compile_pack(filename, folder = MAPS_FOLDER, names = MAP_NAMES, objects = OBJECTS):
+	"""
+	Собирает пак кампании из текстовых карт и файлов объектов.
+	"""
+	header = PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(names))
+	offset = PACK_HEADER.size + PACK_ROOM.size * len(names)
+	records, blobs = [], []
+	for i, name in enumerate(names):
+		room = Room(folder + name)
+		spawns = read_objects(folder + objects[i]) if i < len(objects) else []
+		walk, opaque = terrain_masks(room.map)
+		leave = room.leave_point or Position(-1, -1)
+
+		title = name.encode("utf-8")
+		name_offset = offset
+		tiles_offset = name_offset + len(title)
+		spawn_offset = tiles_offset + 3 * len(room.map)
+		table = b""
+		for obj_name, x, y, args in spawns:
+			text = ";".join([obj_name] + args).encode("utf-8")
+			table += PACK_SPAWN.pack(x, y, len(text)) + text
+		offset = spawn_offset + len(table)
+
+		records.append(PACK_ROOM.pack(room.width, room.height, room.entry_point.x, room.entry_point.y, \
+		                              leave.x, leave.y, name_offset, tiles_offset, spawn_offset, \
+		                              len(title), len(spawns)))
+		blobs += [title, bytes(room.map), walk, opaque, table]
+
+	f = open(filename, "wb")
+	f.write(header + b"".join(records) + b"".join(blobs))
+	f.close()
+
+def load_pack(filename):
+	"""
+	Загружает кампанию из пака: карты копируются из отображённого в память
+	файла целыми кусками, маски берутся готовыми. Возвращает связанный
+	список комнат, у каждой в source - путь к исходной карте рядом с паком.
+	"""
+	f = open(filename, "rb")
+	data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+	f.close()
+	try:
+		magic, version, count = PACK_HEADER.unpack_from(data, 0)
+		if magic != PACK_MAGIC or version != PACK_VERSION:
+			raise ValueError(filename + ": это не пак уровней или он устарел")
+
+		rooms = []
+		for i in range(count):
+			width, height, ex, ey, lx, ly, name_offset, tiles_offset, spawn_offset, name_len, spawn_count = \
+				PACK_ROOM.unpack_from(data, PACK_HEADER.size + PACK_ROOM.size * i)
+			size = width * height
+			view = memoryview(data)
+			tiles = view[tiles_offset : tiles_offset + size]
+			masks = (view[tiles_offset + size : tiles_offset + 2 * size], \
+			         view[tiles_offset + 2 * size : tiles_offset + 3 * size])
+			room = Room(width = width, height = height, tiles = tiles, masks = masks)
+			del tiles, masks, view
+			room.source = os.path.join(os.path.dirname(filename), data[name_offset : name_offset + name_len].decode("utf-8"))
+			room.entry_point = Position(ex, ey)
+			if lx >= 0:
+				room.leave_point = Position(lx, ly)
+
+			offset = spawn_offset
+			for j in range(spawn_count):
+				x, y, length = PACK_SPAWN.unpack_from(data, offset)
+				offset += PACK_SPAWN.size
+				name, *args = data[offset : offset + length].decode("utf-8").split(";")
+				offset += length
+				spawn(room, name, x, y, args)
+			rooms.append(room)
+	finally:
+		data.close()
+	return link_rooms(rooms)
+
+def pack_is_fresh(filename, folder = MAPS_FOLDER, names = MAP_NAMES, objects = OBJECTS):
+	"""
+	Пак есть и собран позже, чем менялся любой из исходников.
+	"""
+	if not os.path.exists(filename):
+		return False
+	built = os.path.getmtime(filename)
+	sources = [folder + name for name in names + objects]
+	return all(os.path.getmtime(source) <= built for source in sources if os.path.exists(source))
+
+def load_campaign(folder = MAPS_FOLDER, names = MAP_NAMES, objects = OBJECTS):
+	"""
+	Комнаты кампании. Берутся из пака, если он не старше исходников,
+	иначе разбираются текстовые карты.
+	"""
+	pack = folder + PACK_NAME
+	if pack_is_fresh(pack, folder, names, objects):
+		rooms = load_pack(pack)
+		#пак мог быть собран для другого списка карт
+		if [os.path.basename(room.source) for room in rooms] == list(names):
+			return rooms
+	return load_text_campaign(folder, names, objects)
+
+#радиусы обзора стандартных существ, для них таблицы обзора запекаются всегда
+BAKE_FOV_RADII = (5, 6)
+
+def bake_room(room, radii = BAKE_FOV_RADII):
+	"""
+	Запекает навигацию и обзор комнаты в файл рядом с её картой: разметку
+	связных областей (с дверями и без), граф кластеров с расстояниями между
+	порталами и таблицы обзора для radii и радиусов всех существ комнаты.
+	Комната должна быть в начальном состоянии, с расставленными объектами -
+	при загрузке данные возьмутся, только если маски совпадут с этими.
+	"""
+	baked = room.baked
+	baked.data = {}
+	for regions in (room.regions, room.door_regions):
+		regions._relabel()
+		baked.put(regions.kind, regions.digest, regions.labels)
+
+	graph = room.clusters
+	graph.dirty = None
+	graph._refresh()
+	baked.put(graph.kind(), graph.digest, (graph.borders, graph.portals, graph.intra, graph.inter))
+
+	for radius in sorted(set(radii) | set(unit.view_dist for unit in room.unit_queue)):
+		baked.put(("fov", radius), FOV_TABLE_FORMAT, FovTable(radius).rows)
+	baked.save()
+
+def bake_campaign(folder = MAPS_FOLDER, names = MAP_NAMES, objects = OBJECTS):
+	for room in load_text_campaign(folder, names, objects):
+		bake_room(room)
+		print("Запечено:", room.baked.filename())
+
+if __name__ == "__main__":
+	#python game_levels.py [файл пака] - собрать пак из maps/
+	#python game_levels.py bake - запечь навигацию и обзор для карт из maps/
+	if len(sys.argv) > 1 and sys.argv[1] == "bake":
+		bake_campaign()
+	else:
+		target = sys.argv[1] if len(sys.argv) > 1 else MAPS_FOLDER + PACK_NAME
+		compile_pack(target)
+		print("Собран пак:", target)
@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+from collections import deque
+from game_utils import *
+
+"""
+Навигационные структуры, которые строятся по комнате целиком
+и переиспользуются разными агентами.
+"""
+
+def ring(pos, radius):
+	"""
+	Клетки на манхэттенском расстоянии ровно radius от pos.
+	"""
+	if radius == 0:
+		return ((pos.x, pos.y),)
+	result = []
+	for dx in range(-radius, radius + 1):
+		dy = radius - abs(dx)
+		result.append((pos.x + dx, pos.y + dy))
+		if dy:
+			result.append((pos.x + dx, pos.y - dy))
+	return tuple(result)
+
+#дальше этого (в шагах) от целей карты расстояний не строятся: гоняются
+#за тестерами только проснувшиеся существа, а они рядом (см. ACTIVITY_RADIUS),
+#дальним же хватает обычного поиска пути
+DISTANCE_MAP_RADIUS = 32
+
+class DistanceMap(object):
+
+	"""
+	Карта расстояний от набора целевых клеток. Строится одним BFS сразу от всех
+	целей по проходимому рельефу (юниты при этом не учитываются, их обходит
+	уже тот, кто по карте ходит). BFS останавливается на расстоянии limit,
+	так что и на большой карте перестройка стоит не больше пары тысяч клеток.
+	complete - обход кончился раньше, и None из get() значит "недостижимо",
+	а не "слишком далеко".
+	"""
+
+	def __init__(self, room, goals, limit = DISTANCE_MAP_RADIUS):
+		self.room = room
+		self.goals = goals
+		self.version = room.terrain_version
+		self.dist = {}
+		self.complete = True
+
+		width, height, walkable = room.width, room.height, room.walk_mask
+		fringe = deque()
+		for goal in goals:
+			x, y = goal
+			if goal not in self.dist and 0 <= x < width and 0 <= y < height and walkable[y * width + x]:
+				self.dist[goal] = 0
+				fringe.append(goal)
+
+		while fringe:
+			x, y = fringe.popleft()
+			d = self.dist[(x, y)] + 1
+			for dx, dy in ((0,-1), (0,1), (-1,0), (1,0)):
+				nx, ny = x + dx, y + dy
+				if 0 <= nx < width and 0 <= ny < height and walkable[ny * width + nx] and (nx, ny) not in self.dist:
+					if d > limit:
+						self.complete = False
+						continue
+					self.dist[(nx, ny)] = d
+					fringe.append((nx, ny))
+
+	def get(self, pos):
+		"""
+		Расстояние до ближайшей цели или None, если целей отсюда не достать.
+		"""
+		return self.dist.get((pos.x, pos.y))
+
+	def next_step(self, pos):
+		"""
+		Свободная соседняя клетка, которая ближе всего к цели. None, если
+		такой нет или ни одна из свободных клеток не приближает к цели.
+		"""
+		best, best_dist = None, self.get(pos)
+		if best_dist is None:
+			return None
+		for dir_ in self.room.get_valid_directions(pos):
+			step = pos + dir_
+			d = self.get(step)
+			if d is not None and d < best_dist:
+				best, best_dist = step, d
+		return best
+
+class DistanceMaps(object):
+
+	"""
+	Общий для всей комнаты кеш карт расстояний. Все, кто идёт к одним и тем же
+	клеткам, пользуются одной картой. Карта перестраивается, только если
+	поменялись цели или рельеф, а неиспользуемые карты выкидываются
+	на каждом ходу комнаты. Карты ограничены DISTANCE_MAP_RADIUS, так что
+	сдвиг цели стоит одного небольшого BFS, а не обхода всей карты.
+	"""
+
+	def __init__(self, room):
+		self.room = room
+		self.maps = {}
+		self.used = set()
+
+	def get(self, goals):
+		dmap = self.maps.get(goals)
+		if not dmap or dmap.version != self.room.terrain_version:
+			dmap = DistanceMap(self.room, goals)
+			self.maps[goals] = dmap
+		self.used.add(goals)
+		return dmap
+
+	def around(self, pos, radius):
+		"""
+		Карта до клеток на расстоянии radius от pos (1 - подойти вплотную).
+		"""
+		return self.get(ring(pos, radius))
+
+	def sweep(self):
+		for goals in set(self.maps) - self.used:
+			self.maps.pop(goals)
+		self.used = set()
+
+class Regions(object):
+
+	"""
+	Разметка комнаты на связные области проходимого рельефа. Если старт и все
+	клетки цели лежат в разных областях, пути точно нет, и искать его незачем.
+	through_doors - двери считаются проходимыми.
+	Целиком разметка строится один раз (или берётся запечённой). Потом комната
+	сообщает о каждой клетке, у которой поменялась проходимость (открыли или
+	закрыли дверь, поставили объект), и разметка правится только вокруг неё:
+	открывшаяся клетка сливает соседние области, закрывшаяся может разрезать
+	свою - тогда от её соседей одновременно идут обходы, и перекрашивается
+	только отрезанная часть, а не вся карта.
+	"""
+
+	def __init__(self, room, through_doors = False):
+		self.room = room
+		self.through_doors = through_doors
+		self.kind = "door_regions" if through_doors else "regions" #имя в запечённых данных
+		self.version = None
+		self.digest = None
+		self.labels = {}
+		self.sizes = {} #метка -> сколько в области клеток
+		self.next_label = 1
+		self.dirty = None #None - разметки ещё нет или она устарела целиком
+
+	def passable(self, pos):
+		if not self.room.in_bounds(pos):
+			return False
+		i = pos.y * self.room.width + pos.x
+		return bool(self.room.walk_mask[i] or (self.through_doors and self.room.door_mask[i]))
+
+	def invalidate(self, pos):
+		"""
+		У клетки pos поменялась проходимость. pos = None - поменялось
+		много всего, и разметку проще построить заново.
+		"""
+		if pos is None:
+			self.dirty = None
+		elif self.dirty is not None:
+			self.dirty.add((pos.x, pos.y))
+
+	def _relabel(self):
+		walkable, doors = self.room.walk_mask, self.room.door_mask
+		version = self.room.terrain_version
+		self.digest = mask_digest(walkable, doors) if self.through_doors else mask_digest(walkable)
+		labels = self.room.baked.get(self.kind, self.digest)
+		if labels is None:
+			labels = self._fill(walkable, doors)
+		self.labels = labels
+		self.sizes = {}
+		for label in labels.values():
+			self.sizes[label] = self.sizes.get(label, 0) + 1
+		self.next_label = max(self.sizes) + 1 if self.sizes else 1
+		self.dirty = set()
+		self.version = version
+
+	def _fill(self, walkable, doors):
+		labels = {}
+		label = 0
+		width, height = self.room.width, self.room.height
+		passable = mask_union(walkable, doors) if self.through_doors else walkable
+		for i in nonzero(passable):
+			y, x = divmod(i, width)
+			if (x, y) in labels:
+				continue
+			label += 1
+			labels[(x, y)] = label
+			fringe = deque([(x, y)])
+			while fringe:
+				cx, cy = fringe.popleft()
+				for dx, dy in ((0,-1), (0,1), (-1,0), (1,0)):
+					nx, ny = cx + dx, cy + dy
+					if 0 <= nx < width and 0 <= ny < height and passable[ny * width + nx] and \
+					   (nx, ny) not in labels:
+						labels[(nx, ny)] = label
+						fringe.append((nx, ny))
+		return labels
+
+	def _neighbours(self, key):
+		labels = self.labels
+		x, y = key
+		return [n for n in ((x, y - 1), (x, y + 1), (x - 1, y), (x + 1, y)) if n in labels]
+
+	def _paint(self, start, old, new):
+		"""
+		Перекрашивает связную область метки old, в которой лежит start, в new.
+		"""
+		labels = self.labels
+		labels[start] = new
+		fringe = deque([start])
+		while fringe:
+			for n in self._neighbours(fringe.popleft()):
+				if labels[n] == old:
+					labels[n] = new
+					fringe.append(n)
+
+	def _open(self, key):
+		"""
+		Клетка key стала проходимой: она присоединяется к соседним областям,
+		а если их несколько, меньшие перекрашиваются в самую большую.
+		"""
+		found = set(self.labels[n] for n in self._neighbours(key))
+		if not found:
+			label = self.next_label
+			self.next_label += 1
+			self.labels[key] = label
+			self.sizes[label] = 1
+			return
+		label = max(found, key = lambda x : self.sizes[x])
+		for n in self._neighbours(key):
+			old = self.labels[n]
+			if old != label:
+				self._paint(n, old, label)
+				self.sizes[label] += self.sizes.pop(old)
+		self.labels[key] = label
+		self.sizes[label] += 1
+
+	def _close(self, key):
+		"""
+		Клетка key стала непроходимой. Её соседи могли оказаться в разных
+		областях, поэтому от каждого идёт свой обход, по клетке за раз.
+		Встретившиеся обходы объединяются. Как только в живых остался один
+		(или все сошлись), остальное уже ясно: закончившиеся обходы
+		и есть отрезанные части, их и перекрашиваем. Так работа
+		пропорциональна отрезанному куску, а не всей области.
+		"""
+		label = self.labels.pop(key)
+		self.sizes[label] -= 1
+		if not self.sizes[label]:
+			self.sizes.pop(label)
+		starts = self._neighbours(key)
+		if len(starts) < 2:
+			return
+
+		owner = dict((start, i) for i, start in enumerate(starts)) #клетка -> чей обход до неё дошёл
+		fringes = [deque([start]) for start in starts]
+		group = list(range(len(starts))) #какие обходы уже встретились
+		def root(i):
+			while group[i] != i:
+				i = group[i]
+			return i
+		def alive():
+			return set(root(i) for i, fringe in enumerate(fringes) if fringe)
+
+		roots = set(range(len(starts)))
+		while len(roots) > 1 and len(alive()) > 1:
+			for i, fringe in enumerate(fringes):
+				if not fringe:
+					continue
+				for n in self._neighbours(fringe.popleft()):
+					if n not in owner:
+						owner[n] = i
+						fringe.append(n)
+					elif root(owner[n]) != root(i):
+						group[root(owner[n])] = root(i)
+			roots = set(root(i) for i in range(len(starts)))
+		if len(roots) == 1:
+			return
+
+		#старая метка остаётся недообойдённой части, а если закончились все - самой большой
+		counts = {}
+		for i in owner.values():
+			counts[root(i)] = counts.get(root(i), 0) + 1
+		keep = alive() or roots
+		keep = max(keep, key = lambda r : counts[r])
+		for r in roots - set([keep]):
+			new = self.next_label
+			self.next_label += 1
+			for tile, i in owner.items():
+				if root(i) == r:
+					self.labels[tile] = new
+			self.sizes[new] = counts[r]
+			self.sizes[label] -= counts[r]
+
+	def _patch(self):
+		for x, y in self.dirty:
+			key = (x, y)
+			if self.passable(Position(x, y)) != (key in self.labels):
+				if key in self.labels:
+					self._close(key)
+				else:
+					self._open(key)
+		self.dirty = set()
+		self.version = self.room.terrain_version
+
+	def label(self, pos):
+		if self.version != self.room.terrain_version:
+			if self.dirty is None:
+				self._relabel()
+			else:
+				self._patch()
+		return self.labels.get((pos.x, pos.y))
+
+	def reaches(self, start, goals):
+		"""
+		Можно ли из start дойти хоть до одной из клеток goals (кортежи координат).
+		Если сам start не размечен, отвечаем "можно" - пусть решает поиск.
+		"""
+		label = self.label(start)
+		if label is None:
+			return True
+		for goal in goals:
+			if self.labels.get(goal) == label:
+				return True
+		return False
+
+UNIT_BUCKET = 8
+
+class SpatialIndex(object):
+
+	"""
+	Юниты комнаты, разложенные по квадратным корзинам со стороной size,
+	а внутри корзины - по фракциям. Комната обновляет индекс в add, move и
+	remove. Запрос "юниты фракции рядом" перебирает только корзины, задетые
+	областью запроса, а не все её клетки. Результаты отсортированы по (y, x) -
+	в том же порядке, в каком их дал бы проход по клеткам.
+	"""
+
+	def __init__(self, size = UNIT_BUCKET):
+		self.size = size
+		self.buckets = {} #(bx, by) -> {фракция: {юнит: None}}
+		self.where = {} #юнит -> (корзина, фракция), куда он записан
+		self.factions = {} #фракция -> {юнит: None}, в порядке появления
+
+	def __len__(self):
+		return len(self.where)
+
+	def add(self, unit):
+		key = (unit.position.x // self.size, unit.position.y // self.size)
+		self.buckets.setdefault(key, {}).setdefault(unit.faction, {})[unit] = None
+		self.where[unit] = (key, unit.faction)
+		self.factions.setdefault(unit.faction, {})[unit] = None
+
+	def remove(self, unit):
+		key, faction = self.where.pop(unit)
+		self.factions[faction].pop(unit)
+		bucket = self.buckets[key]
+		bucket[faction].pop(unit)
+		if not bucket[faction]:
+			bucket.pop(faction)
+			if not bucket:
+				self.buckets.pop(key)
+
+	def move(self, unit):
+		"""
+		Юнит уже сменил position, переносим его в новую корзину, если надо.
+		"""
+		key = (unit.position.x // self.size, unit.position.y // self.size)
+		if self.where[unit] != (key, unit.faction):
+			self.remove(unit)
+			self.add(unit)
+
+	def count(self, faction):
+		return len(self.factions.get(faction, ()))
+
+	def members(self, faction):
+		return list(self.factions.get(faction, ()))
+
+	def in_rect(self, x0, y0, x1, y1, faction = None):
+		"""
+		Юниты (фракции faction, если задана) в прямоугольнике x0..x1, y0..y1
+		включительно.
+		"""
+		result = []
+		size = self.size
+		for by in range(y0 // size, y1 // size + 1):
+			for bx in range(x0 // size, x1 // size + 1):
+				bucket = self.buckets.get((bx, by))
+				if not bucket:
+					continue
+				groups = bucket.values() if faction is None else (bucket.get(faction, ()),)
+				for units in groups:
+					for unit in units:
+						pos = unit.position
+						if x0 <= pos.x <= x1 and y0 <= pos.y <= y1:
+							result.append(unit)
+		result.sort(key = lambda unit : (unit.position.y, unit.position.x))
+		return result
+
+	def in_radius(self, pos, radius, faction = None):
+		"""
+		Юниты не дальше radius от pos по манхэттену.
+		"""
+		units = self.in_rect(pos.x - radius, pos.y - radius, pos.x + radius, pos.y + radius, faction)
+		return [unit for unit in units if unit.position.manhattan(pos) <= radius]
+
+	def in_mask(self, mask, faction = None):
+		"""
+		Юниты на клетках маски TileMask (например, видимых существом).
+		"""
+		bounds = mask.bounds()
+		if not bounds:
+			return []
+		return [unit for unit in self.in_rect(*bounds, faction = faction) if unit.position in mask]
+
+class Route(object):
+
+	"""
+	Остаток маршрута агента. steps начинается с клетки, соседней с агентом.
+	partial - маршрут ведёт только до ближайшего ориентира на пути к goal.
+	"""
+
+	def __init__(self, steps, goal, kind, partial = False):
+		self.steps = steps
+		self.goal = goal
+		self.kind = kind
+		self.partial = partial
+
+class PathCache(object):
+
+	"""
+	Кеш маршрутов агентов комнаты. Маршрут живёт, пока на него никто не
+	встал: комната сообщает о каждой клетке, которая стала непроходимой
+	(туда пришёл юнит, закрылась дверь, поставили объект), и все маршруты
+	через неё выкидываются.
+	"""
+
+	def __init__(self):
+		self.routes = {}
+		self.tiles = {}
+
+	def get(self, agent, kind):
+		route = self.routes.get(agent)
+		if route and route.kind == kind:
+			return route
+		return None
+
+	def put(self, agent, route):
+		self.drop(agent)
+		self.routes[agent] = route
+		for pos in route.steps:
+			self.tiles.setdefault((pos.x, pos.y), set()).add(agent)
+
+	def advance(self, agent, route):
+		"""
+		Выкидывает из начала маршрута уже пройденную клетку.
+		"""
+		pos = route.steps.pop(0)
+		agents = self.tiles.get((pos.x, pos.y))
+		if agents and pos not in route.steps:
+			agents.discard(agent)
+			if not agents:
+				self.tiles.pop((pos.x, pos.y))
+
+	def drop(self, agent):
+		route = self.routes.pop(agent, None)
+		if not route:
+			return
+		for pos in route.steps:
+			agents = self.tiles.get((pos.x, pos.y))
+			if agents:
+				agents.discard(agent)
+				if not agents:
+					self.tiles.pop((pos.x, pos.y))
+
+	def block(self, pos, unit = None):
+		"""
+		Клетка pos стала непроходимой. Маршрут самого unit (он туда и шёл)
+		не трогаем.
+		"""
+		agents = self.tiles.get((pos.x, pos.y))
+		if agents:
+			for agent in agents.copy():
+				if agent is not unit:
+					self.drop(agent)
+
+CLUSTER_SIZE = 8
+
+class ClusterGraph(object):
+
+	"""
+	Иерархический граф для дальних путей (HPA*). Комната режется на квадратные
+	кластеры, на общих границах соседних кластеров выбираются проходы (порталы),
+	а внутри кластера заранее считаются расстояния между его порталами.
+	Дальний запрос решается на графе порталов, а по клеткам уточняется
+	только первый отрезок пути. Двери считаются проходимыми - так ходит
+	тот, кто умеет их открывать.
+	"""
+
+	def __init__(self, room, size = CLUSTER_SIZE):
+		self.room = room
+		self.size = size
+		self.borders = {}
+		self.portals = {}
+		self.intra = {}
+		self.inter = {}
+		self.dirty = None #None - граф ещё ни разу не строился
+		self.digest = None #отпечаток карты, по которой граф строился целиком
+
+	def passable(self, x, y):
+		room = self.room
+		if not (0 <= x < room.width and 0 <= y < room.height):
+			return False
+		i = y * room.width + x
+		return bool(room.walk_mask[i] or room.door_mask[i])
+
+	def cluster(self, x, y):
+		return (x // self.size, y // self.size)
+
+	def clusters(self):
+		cols = (self.room.width + self.size - 1) // self.size
+		rows = (self.room.height + self.size - 1) // self.size
+		walkable, doors = self.room.walk_mask, self.room.door_mask
+		if isinstance(walkable, ChunkedArray) and not walkable.fill:
+			#в разреженной комнате кластеры без проходимых кусков не нужны
+			result = set()
+			for cx, cy in set(walkable.chunks) | set(doors.chunks):
+				for x in range(cx * CHUNK // self.size, min(((cx + 1) * CHUNK - 1) // self.size + 1, cols)):
+					for y in range(cy * CHUNK // self.size, min(((cy + 1) * CHUNK - 1) // self.size + 1, rows)):
+						result.add((x, y))
+			return sorted(result)
+		return [(cx, cy) for cx in range(cols) for cy in range(rows)]
+
+	def invalidate(self, pos):
+		if self.dirty is not None:
+			self.dirty.add(self.cluster(pos.x, pos.y))
+
+	def _neighbours(self, c):
+		cols = (self.room.width + self.size - 1) // self.size
+		rows = (self.room.height + self.size - 1) // self.size
+		result = []
+		for dx, dy in ((1,0), (-1,0), (0,1), (0,-1)):
+			if 0 <= c[0] + dx < cols and 0 <= c[1] + dy < rows:
+				result.append((c[0] + dx, c[1] + dy))
+		return result
+
+	def _border(self, c1, c2):
+		"""
+		Проходы между c1 и соседом справа или снизу c2. Короткий проход даёт
+		одну пару клеток посередине, длинный - по паре на каждом конце.
+		"""
+		size = self.size
+		if c2[0] > c1[0]:
+			x = c2[0] * size
+			if x >= self.room.width:
+				return []
+			span = [((x - 1, y), (x, y)) for y in range(c1[1] * size, min((c1[1] + 1) * size, self.room.height))]
+		else:
+			y = c2[1] * size
+			if y >= self.room.height:
+				return []
+			span = [((x, y - 1), (x, y)) for x in range(c1[0] * size, min((c1[0] + 1) * size, self.room.width))]
+
+		result = []
+		run = []
+		for a, b in span + [(None, None)]:
+			if a and self.passable(*a) and self.passable(*b):
+				run.append((a, b))
+				continue
+			if len(run) >= 6:
+				result += [run[0], run[-1]]
+			elif run:
+				result.append(run[len(run) // 2])
+			run = []
+		return result
+
+	def _reach(self, start, c):
+		"""
+		BFS внутри кластера c от клетки start. Возвращает словарь расстояний.
+		"""
+		x0, y0 = c[0] * self.size, c[1] * self.size
+		x1, y1 = x0 + self.size, y0 + self.size
+		dist = {start: 0}
+		fringe = deque([start])
+		while fringe:
+			x, y = fringe.popleft()
+			d = dist[(x, y)] + 1
+			for dx, dy in ((0,-1), (0,1), (-1,0), (1,0)):
+				key = (x + dx, y + dy)
+				if key not in dist and x0 <= key[0] < x1 and y0 <= key[1] < y1 and self.passable(*key):
+					dist[key] = d
+					fringe.append(key)
+		return dist
+
+	def kind(self):
+		return ("clusters", self.size)
+
+	def _refresh(self):
+		if self.dirty is None:
+			#целиком граф строится один раз, и его можно взять запечённым
+			self.digest = mask_digest(self.room.walk_mask, self.room.door_mask)
+			baked = self.room.baked.get(self.kind(), self.digest)
+			if baked is not None:
+				self.borders, self.portals, self.intra, self.inter = baked
+				self.dirty = set()
+				return
+			self.dirty = set(self.clusters())
+		if not self.dirty:
+			return
+
+		affected = set(self.dirty)
+		for c in self.dirty:
+			affected.update(self._neighbours(c))
+		for c in self.dirty:
+			for n in self._neighbours(c):
+				c1, c2 = min(c, n), max(c, n)
+				self.borders[(c1, c2)] = self._border(c1, c2)
+		self.dirty = set()
+
+		self.inter = {}
+		for c in affected:
+			self.portals[c] = set()
+		for (c1, c2), pairs in self.borders.items():
+			for a, b in pairs:
+				self.inter.setdefault(a, set()).add(b)
+				self.inter.setdefault(b, set()).add(a)
+				for p in (a, b):
+					if self.cluster(*p) in affected:
+						self.portals[self.cluster(*p)].add(p)
+
+		for c in affected:
+			self.intra[c] = {}
+			for p in self.portals[c]:
+				dist = self._reach(p, c)
+				self.intra[c][p] = {q : dist[q] for q in self.portals[c] if q != p and q in dist}
+
+	def path(self, start, goal):
+		"""
+		Путь по графу порталов от start до goal (кортежи координат) - список
+		точек-ориентиров без start. Пустой список, если пути нет.
+		"""
+		self._refresh()
+		sc, gc = self.cluster(*start), self.cluster(*goal)
+		start_reach = self._reach(start, sc)
+		goal_reach = self._reach(goal, gc)
+
+		def neighbours(node):
+			if node == start:
+				result = [(p, start_reach[p]) for p in self.portals.get(sc, ()) if p in start_reach]
+				result += [(q, 1) for q in self.inter.get(node, ())]
+				if goal in start_reach:
+					result.append((goal, start_reach[goal]))
+				return result
+			c = self.cluster(*node)
+			result = list(self.intra.get(c, {}).get(node, {}).items())
+			result += [(q, 1) for q in self.inter.get(node, ())]
+			if c == gc and node in goal_reach:
+				result.append((goal, goal_reach[node]))
+			return result
+
+		h = lambda node : abs(node[0] - goal[0]) + abs(node[1] - goal[1])
+		counter = itertools.count()
+		fringe = [(h(start), next(counter), start)]
+		costs = {start: 0}
+		parents = {start: None}
+		closed = set()
+		while fringe:
+			node = heapq.heappop(fringe)[2]
+			if node == goal:
+				result = []
+				while node != start:
+					result.append(node)
+					node = parents[node]
+				result.reverse()
+				return result
+			if node in closed:
+				continue
+			closed.add(node)
+			for other, cost in neighbours(node):
+				g = costs[node] + cost
+				if other not in closed and g < costs.get(other, g + 1):
+					costs[other] = g
+					parents[other] = node
+					heapq.heappush(fringe, (g + h(other), next(counter), other))
+		return []
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import random
+import itertools
+import multiprocessing
+import game_core
+from game_core import *
+
+"""
+Параллельный прогон комнат. Комнаты связаны только переходами < и >,
+поэтому каждая может ходить в своём процессе: юниты, ушедшие в соседнюю
+комнату, передаются сообщениями на границе хода, а логи и признак
+наблюдателя собираются в родительском процессе. Это для долгих прогонов
+без игрока: ввод с клавиатуры из рабочих процессов не читается.
+"""
+
+class RemoteRoom(object):
+
+	"""
+	Заглушка соседней комнаты в рабочем процессе. Room.send() кладёт
+	уходящего юнита в outbox вместе с ней, а раннер по index понимает,
+	в какой процесс его отправить.
+	"""
+
+	def __init__(self, index, room):
+		self.index = index
+		self.entry_point = room.entry_point
+		self.leave_point = room.leave_point
+
+def _serve(rooms, index, seed, conn):
+	"""
+	Цикл рабочего процесса комнаты rooms[index]. Процесс получен fork'ом,
+	так что все комнаты у него уже есть, но ходит он только своей.
+	"""
+	#иначе у всех процессов был бы один и тот же поток случайных чисел
+	random.seed(seed + index)
+	#и одни и те же номера новых существ
+	game_core.unit_ids = itertools.count((index + 1) << 32)
+
+	room = rooms[index]
+	room.outbox = []
+	for other in range(len(rooms)):
+		if room.next_room is rooms[other]:
+			room.next_room = RemoteRoom(other, rooms[other])
+		if room.prev_room is rooms[other]:
+			room.prev_room = RemoteRoom(other, rooms[other])
+
+	while True:
+		command, payload = conn.recv()
+		if command == "step":
+			for unit, position in payload:
+				#вызванные существа приходят следом за хозяином, см. Room.send
+				unit._place(room, position or room.nearest_free(unit.master.position))
+			for unit, position in payload:
+				unit._resolve_summons(room)
+			observer = room.step()
+			departures = [(unit, target.index, position) for unit, target, position in room.outbox]
+			room.outbox = []
+			log, room.log = room.log, []
+			conn.send((observer, departures, log))
+		elif command == "call":
+			function, args = payload
+			conn.send(function(room, *args))
+		else:
+			conn.close()
+			return
+
+class RoomRunner(object):
+
+	"""
+	Ходит комнатами rooms, каждой в своём процессе. step() - один ход всех
+	комнат, возвращает True, если где-то есть игрок, как Room.step().
+	Юнит, ушедший через переход, появляется в соседней комнате к началу
+	её следующего хода. Логи последнего хода лежат в logs, по комнатам.
+	Без fork (Windows) или с processes = False процессы не заводятся,
+	и комнаты ходят по очереди в этом же процессе, как в game.py.
+	"""
+
+	def __init__(self, rooms, processes = True):
+		self.rooms = rooms
+		self.logs = [[] for room in rooms]
+		self.arrivals = [[] for room in rooms]
+		self.workers = []
+		self.pipes = []
+		if not processes:
+			return
+		try:
+			context = multiprocessing.get_context("fork")
+		except ValueError:
+			return
+
+		seed = random.getrandbits(32)
+		for index in range(len(rooms)):
+			parent, child = context.Pipe()
+			worker = context.Process(target = _serve, args = (rooms, index, seed, child), daemon = True)
+			worker.start()
+			child.close()
+			self.workers.append(worker)
+			self.pipes.append(parent)
+
+	def step(self):
+		if not self.workers:
+			observer = False
+			for index, room in enumerate(self.rooms):
+				observer = room.step() or observer
+				self.logs[index], room.log = room.log, []
+			return observer
+
+		for index, pipe in enumerate(self.pipes):
+			pipe.send(("step", self.arrivals[index]))
+			self.arrivals[index] = []
+
+		observer = False
+		for index, pipe in enumerate(self.pipes):
+			room_observer, departures, self.logs[index] = pipe.recv()
+			observer = room_observer or observer
+			for unit, target, position in departures:
+				self.arrivals[target].append((unit, position))
+		return observer
+
+	def call(self, index, function, *args):
+		"""
+		Результат function(комната, *args) для комнаты index, посчитанный
+		там, где комната живёт. function должна быть обычной функцией
+		модуля, её передают в процесс по имени.
+		"""
+		if not self.workers:
+			return function(self.rooms[index], *args)
+		self.pipes[index].send(("call", (function, args)))
+		return self.pipes[index].recv()
+
+	def close(self):
+		for pipe in self.pipes:
+			pipe.send(("stop", None))
+			pipe.close()
+		for worker in self.workers:
+			worker.join()
+		self.workers = []
+		self.pipes = []
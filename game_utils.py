@@ -1,28 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import os
+import heapq
 import random
 import math
+import itertools
+import marshal
+import hashlib
 
 """
 Всякие вспомогательные классы и функции
 """
 
-class LoopedTuple(object):
-
-	def __init__(self, data):
-		self.data = data
-		self.len = len(data)
-
-	def __getitem__(self, index):
-		return self.data[index % self.len]
+#код стены в Room.map (карта хранится байтами, по байту на клетку)
+WALL = ord("#")
 
 class Node(object):
 
-	def __init__(self, value):
+	"""
+	Узел поиска пути. Хранит только ссылку на родителя, путь
+	восстанавливается проходом по родителям.
+	"""
+
+	def __init__(self, value, parent = None):
 		self.value = value
-		self.children = []
-		self.parent = None
-		self.depth = 0
+		self.parent = parent
+		self.depth = parent.depth + 1 if parent else 0
 
 	def __eq__(self, other):
 		return self.value == other.value
@@ -30,11 +33,6 @@ class Node(object):
 	def __hash__(self):
 		return self.value.__hash__()
 
-	def add_child(self, child):
-		child.parent = self
-		child.depth = self.depth + 1
-		self.children.append(child)
-
 class Position(object):
 
 	"""
@@ -71,114 +69,462 @@ class Position(object):
 
 	def dist(self, other):
 		d = (self.x - other.x, self.y - other.y)
-		if d not in Position.cache:
-			Position.cache[d] = round(math.hypot(self.x - other.x, self.y - other.y))
-		return Position.cache[d]
+		if d in Position.cache:
+			return Position.cache[d]
+		#дальние расстояния не кешируем, иначе на больших картах кеш растёт без конца
+		return round(math.hypot(d[0], d[1]))
 
 	def touch(self, other):
 		return self.manhattan(other) <= 1
 
-class PredicateDict(object):
+class TileMask(object):
 
 	"""
-	Отдаст только те значения, для которых истинен предикат от 
-	переданного с ключом аргумента
+	Множество клеток в виде битовых масок по рядам: rows[y] - целое число,
+	в котором бит (x - x0) означает клетку (x, y). Пустых рядов в словаре нет.
+	Объединение, пересечение и разность делаются целочисленными операциями
+	над рядами, без перебора клеток.
 	"""
 
-	def __init__(self):
-		self.data = {}
+	def __init__(self, rows = None, x0 = 0):
+		self.rows = rows if rows is not None else {}
+		self.x0 = x0
 
-	def set(self, key, value, predicate = lambda x : True):
-		self.data[key] = (predicate, value)
+	def __contains__(self, pos):
+		if not pos:
+			return False
+		bit = pos.x - self.x0
+		return bit >= 0 and (self.rows.get(pos.y, 0) >> bit) & 1 == 1
 
-	def get(self, key, arg):
-		entry = self.data[key]
-		if entry[0](arg):
-			return entry[1]
-		else:
-			raise KeyError
+	def __iter__(self):
+		for x, y in self.cells():
+			yield Position(x, y)
 
-	def delete(self, key):
-		self.data.pop(key)
+	def __len__(self):
+		return sum(bin(bits).count("1") for bits in self.rows.values())
 
-	def keys(self, arg):
-		return [key for key in self.data if self.data[key][0](arg)]
+	def __bool__(self):
+		return bool(self.rows)
 
-	def values(self, arg):
-		return [self.data[key] for key in self.data if self.data[key][0](arg)]
+	def bounds(self):
+		"""
+		Ограничивающий прямоугольник (x0, y0, x1, y1) включительно
+		или None для пустой маски.
+		"""
+		if not self.rows:
+			return None
+		low = min((bits & -bits).bit_length() for bits in self.rows.values()) - 1
+		high = max(bits.bit_length() for bits in self.rows.values()) - 1
+		return self.x0 + low, min(self.rows), self.x0 + high, max(self.rows)
 
-class Rational(object):
+	def __eq__(self, other):
+		if not isinstance(other, TileMask):
+			return NotImplemented
+		a, b, x0 = self._aligned(other)
+		return a == b
+
+	def __or__(self, other):
+		a, b, x0 = self._aligned(other)
+		rows = dict(a)
+		for y, bits in b.items():
+			rows[y] = rows.get(y, 0) | bits
+		return TileMask(rows, x0)
+
+	def __and__(self, other):
+		a, b, x0 = self._aligned(other)
+		rows = {}
+		for y, bits in a.items():
+			both = bits & b.get(y, 0)
+			if both:
+				rows[y] = both
+		return TileMask(rows, x0)
+
+	def __sub__(self, other):
+		a, b, x0 = self._aligned(other)
+		rows = {}
+		for y, bits in a.items():
+			rest = bits & ~b.get(y, 0)
+			if rest:
+				rows[y] = rest
+		return TileMask(rows, x0)
+
+	def add(self, pos):
+		if pos.x < self.x0:
+			shift = self.x0 - pos.x
+			self.rows = {y : bits << shift for y, bits in self.rows.items()}
+			self.x0 = pos.x
+		self.rows[pos.y] = self.rows.get(pos.y, 0) | (1 << (pos.x - self.x0))
+
+	def cells(self):
+		"""
+		Клетки кортежами (x, y), по рядам сверху вниз. Без создания Position.
+		"""
+		for y in sorted(self.rows):
+			bits = self.rows[y]
+			while bits:
+				low = bits & -bits
+				yield (self.x0 + low.bit_length() - 1, y)
+				bits ^= low
+
+	def _aligned(self, other):
+		"""
+		Ряды обеих масок, приведённые к общему x0.
+		"""
+		if self.x0 == other.x0:
+			return self.rows, other.rows, self.x0
+		x0 = min(self.x0, other.x0)
+		a = {y : bits << (self.x0 - x0) for y, bits in self.rows.items()}
+		b = {y : bits << (other.x0 - x0) for y, bits in other.rows.items()}
+		return a, b, x0
+
+class TimerWheel(object):
 
 	"""
-	Используется в Creature._shadowcast из-за проблем со сравнением флоатов
+	Колесо таймеров. Таймер кладётся в ячейку своего хода по модулю размера
+	колеса, и за ход просматривается только одна ячейка, так что стоимость
+	хода зависит от числа сработавших таймеров, а не от числа заведённых.
+	Таймеры дальше одного оборота просто ждут в ячейке следующего.
 	"""
 
-	def __init__(self, numerator = 0, denominator = 1):
-		self.numerator = numerator
-		self.denominator = denominator
+	def __init__(self, size = 64):
+		self.size = size
+		self.slots = [[] for i in range(size)]
+		self.now = 0 #сколько ходов уже прокручено
+		self.count = 0
 
-	def __eq__(self, other):
-		return self.numerator * other.denominator == other.numerator * self.denominator
+	def __len__(self):
+		return self.count
+
+	def schedule(self, delay, callback, *args):
+		"""
+		Вызвать callback(*args) через delay ходов (не меньше одного).
+		Возвращает таймер, который можно отменить через cancel().
+		"""
+		timer = [self.now + max(delay, 1), callback, args]
+		self.slots[timer[0] % self.size].append(timer)
+		self.count += 1
+		return timer
 
-	def __lt__(self, other):
-		return self.numerator * other.denominator <  other.numerator * self.denominator
+	def cancel(self, timer):
+		if timer[1]:
+			timer[1] = None
+			self.count -= 1
 
-	def __le__(self, other):
-		return self.numerator * other.denominator <= other.numerator * self.denominator
+	def advance(self):
+		"""
+		Прокручивает колесо на ход и вызывает всё, что на этот ход назначено,
+		в порядке назначения. Таймеры, заведённые прямо из callback, на этот
+		же ход не попадают.
+		"""
+		self.now += 1
+		slot = self.slots[self.now % self.size]
+		due = [timer for timer in slot if timer[0] <= self.now]
+		if not due:
+			return
+		slot[:] = [timer for timer in slot if timer[0] > self.now]
+		for timer in due:
+			callback = timer[1]
+			if callback:
+				timer[1] = None
+				self.count -= 1
+				callback(*timer[2])
 
-class RealLine(object):
+class Scheduler(object):
 
 	"""
-	Линия с отрезками на ней. Используется в Creature_.shadowcast.
+	Очередь ходов комнаты на двоичной куче. Ключ - (время хода, ранг), ранг
+	выдаётся при добавлении и не меняется, так что юниты, которым ходить
+	в одно время, ходят в порядке появления в комнате. Удаление и перенос
+	ленивые: старая запись в куче просто помечается мёртвой, поэтому и то,
+	и другое стоит O(log n). Третье поле записи - её порядковый номер, чтобы
+	мёртвая и живая записи одного юнита никогда не сравнивались по юниту.
 	"""
 
 	def __init__(self):
-		self.lines = []
+		self.heap = []
+		self.entries = {} #юнит -> [время, ранг, номер, юнит] - его живая запись
+		self.serials = itertools.count()
+		self.ranks = itertools.count()
 
-	def add(self, line):
-		insert_to_sorted(self.lines, line, lambda x, y: x[0] < y[0])
+	def __len__(self):
+		return len(self.entries)
 
-	def append(self, line):
+	def __contains__(self, unit):
+		return unit in self.entries
+
+	def __iter__(self):
 		"""
-		В Creature._shadowcast начало каждого следующего отрезка не может быть меньше предыдущего, 
-		поэтому тут можно чуть сэкономить и не запариваться с поиском нужной позиции в списке.
+		Юниты в порядке очереди.
 		"""
-		self.lines.append(line)
+		return iter([entry[3] for entry in sorted(self.entries.values())])
 
-	def merge(self, other):
+	def add(self, unit, time):
+		entry = [time, next(self.ranks), next(self.serials), unit]
+		self.entries[unit] = entry
+		heapq.heappush(self.heap, entry)
 
-		i, j = 0, 0
-		while i < len(self.lines) and j < len(other.lines):
-			if other.lines[j] < self.lines[i]:
-				self.lines.insert(i, other.lines[j])
-				j += 1
-			else:
-				i += 1
-		while j < len(other.lines):
-			self.lines.append(other.lines[j])
-			j += 1
+	def remove(self, unit):
+		entry = self.entries.pop(unit)
+		entry[3] = None
+		self._compact()
 
-		self.unite()
+	def schedule(self, unit, time):
+		"""
+		Назначить юниту, который уже есть в очереди, новое время хода.
+		"""
+		entry = self.entries[unit]
+		entry[3] = None
+		entry = [time, entry[1], next(self.serials), unit]
+		self.entries[unit] = entry
+		heapq.heappush(self.heap, entry)
+		self._compact()
+
+	def wake(self, unit, time):
+		"""
+		Передвинуть ход юнита на time, если он назначен на более позднее время.
+		"""
+		entry = self.entries.get(unit)
+		if entry and entry[0] > time:
+			self.schedule(unit, time)
+
+	def pop(self, limit):
+		"""
+		Следующий юнит, чьё время хода не позже limit, и это время; (None, None),
+		если таких нет. Юнит остаётся в комнате, но из кучи уходит, пока ему
+		снова не назначат время через schedule().
+		"""
+		while self.heap and self.heap[0][0] <= limit:
+			time, rank, serial, unit = heapq.heappop(self.heap)
+			if unit is not None:
+				self.entries[unit] = [time, rank, serial, unit] #уже не в куче
+				return unit, time
+		return None, None
+
+	def _compact(self):
+		#мёртвых записей стало слишком много - пересобираем кучу
+		if len(self.heap) > 2 * len(self.entries) + 64:
+			self.heap = [entry for entry in self.heap if entry[3] is not None]
+			heapq.heapify(self.heap)
+
+CHUNK_BITS = 5
+CHUNK = 1 << CHUNK_BITS #сторона куска ChunkedArray
+CHUNK_MASK = CHUNK - 1
+
+class ChunkedArray(object):
+
+	"""
+	Разреженная замена плоского буфера комнаты для очень больших карт.
+	Индексируется так же, числом y * width + x, но хранит только куски
+	CHUNK x CHUNK, где есть хоть одно значение, отличное от fill. Кусок
+	заводится при первой записи такого значения. kind - bytearray для масок
+	и клеток или list для юнитов и объектов.
+	"""
 
-	def unite(self):
-		if not self.lines:
+	def __init__(self, width, height, fill = 0, kind = bytearray):
+		self.width = width
+		self.height = height
+		self.fill = fill
+		self.kind = kind
+		self.chunks = {}
+
+	def __len__(self):
+		return self.width * self.height
+
+	def __getitem__(self, i):
+		y, x = divmod(i, self.width)
+		chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+		if chunk is None:
+			return self.fill
+		return chunk[((y & CHUNK_MASK) << CHUNK_BITS) | (x & CHUNK_MASK)]
+
+	def __setitem__(self, i, value):
+		y, x = divmod(i, self.width)
+		key = (x >> CHUNK_BITS, y >> CHUNK_BITS)
+		chunk = self.chunks.get(key)
+		if chunk is None:
+			if value is self.fill or value == self.fill:
+				return
+			chunk = self.kind([self.fill]) * (CHUNK * CHUNK)
+			self.chunks[key] = chunk
+		chunk[((y & CHUNK_MASK) << CHUNK_BITS) | (x & CHUNK_MASK)] = value
+
+	def nonzero(self):
+		"""
+		Индексы всех истинных значений (в порядке кусков, а не строк).
+		"""
+		if self.fill:
+			yield from range(len(self))
 			return
-		i = 1
-		line = self.lines[0]
-		while i < len(self.lines):
-			if line[1] >= self.lines[i][0]:
-				line[1] = max(line[1], self.lines[i][1])
-				self.lines.pop(i)
-			else:
-				line = self.lines[i]
-				i += 1
-
-	def contains(self, line):
-		for interval in self.lines:
-			if interval[0] <= line[0] and \
-			   interval[1] >= line[1]:
-				return True
-		return False
+		for (cx, cy), chunk in self.chunks.items():
+			for j, value in enumerate(chunk):
+				if value:
+					x = (cx << CHUNK_BITS) | (j & CHUNK_MASK)
+					y = (cy << CHUNK_BITS) | (j >> CHUNK_BITS)
+					if x < self.width and y < self.height:
+						yield y * self.width + x
+
+	def union(self, other):
+		"""
+		Поэлементное ИЛИ двух байтовых масок одного размера.
+		"""
+		result = ChunkedArray(self.width, self.height, self.fill | other.fill)
+		for key in set(self.chunks) | set(other.chunks):
+			a = self.chunks.get(key) or bytearray([self.fill]) * (CHUNK * CHUNK)
+			b = other.chunks.get(key) or bytearray([other.fill]) * (CHUNK * CHUNK)
+			result.chunks[key] = bytearray(x | y for x, y in zip(a, b))
+		return result
+
+	def update_digest(self, digest):
+		digest.update(bytes([self.fill]))
+		for key in sorted(self.chunks):
+			digest.update(repr(key).encode())
+			digest.update(self.chunks[key])
+
+def nonzero(mask):
+	"""
+	Индексы истинных значений плоского буфера или ChunkedArray.
+	"""
+	if isinstance(mask, ChunkedArray):
+		return mask.nonzero()
+	return (i for i, value in enumerate(mask) if value)
+
+def mask_union(a, b):
+	if isinstance(a, ChunkedArray):
+		return a.union(b)
+	return bytes(x | y for x, y in zip(a, b))
+
+BAKE_SUFFIX = ".bake"
+
+def mask_digest(*masks):
+	"""
+	Отпечаток масок комнаты, по которому проверяется, что запечённые
+	данные посчитаны именно для такой карты.
+	"""
+	digest = hashlib.md5()
+	for mask in masks:
+		if isinstance(mask, ChunkedArray):
+			mask.update_digest(digest)
+		else:
+			digest.update(mask)
+	return digest.hexdigest()
+
+#данные в .bake - только простые значения, код из файла не выполняется
+BAKE_HEADER = b"BAKE1"
+BAKE_TYPES = (int, str, bytes, tuple, list, dict, set, frozenset, type(None))
+
+def plain_data(value):
+	"""
+	Состоит ли value только из BAKE_TYPES. marshal умеет читать и объекты
+	кода, так что всё прочитанное из .bake проверяется этим.
+	"""
+	stack = [value]
+	while stack:
+		value = stack.pop()
+		if type(value) not in BAKE_TYPES:
+			return False
+		if isinstance(value, dict):
+			stack.extend(value.keys())
+			stack.extend(value.values())
+		elif isinstance(value, (tuple, list, set, frozenset)):
+			stack.extend(value)
+	return True
+
+class Baked(object):
+
+	"""
+	Запечённые заранее данные комнаты (см. game_levels.bake_room) из файла
+	рядом с картой. Файл читается при первом обращении. Каждая запись
+	хранится вместе с отпечатком того, из чего она посчитана, и md5 самой
+	записи, и отдаётся, только если оба совпали. Формат - marshal, а не
+	pickle: из чужого .bake можно получить разве что неверные данные,
+	но не запуск кода. Отдаётся всегда свежая копия, так что её можно
+	спокойно менять.
+	"""
+
+	def __init__(self, room):
+		self.room = room
+		self.data = None
+
+	def filename(self):
+		return self.room.source + BAKE_SUFFIX if self.room.source else None
+
+	def _load(self):
+		filename = self.filename()
+		if not filename or not os.path.exists(filename):
+			return {}
+		try:
+			with open(filename, "rb") as f:
+				raw = f.read()
+			if not raw.startswith(BAKE_HEADER):
+				return {}
+			data = marshal.loads(raw[len(BAKE_HEADER):])
+		except (OSError, EOFError, ValueError, TypeError):
+			return {}
+		if not isinstance(data, dict) or not plain_data(data):
+			return {}
+		return data
+
+	def get(self, kind, digest):
+		if self.data is None:
+			self.data = self._load()
+		entry = self.data.get(kind)
+		if not isinstance(entry, tuple) or len(entry) != 3 or entry[0] != digest:
+			return None
+		payload, checksum = entry[1], entry[2]
+		if not isinstance(payload, bytes) or hashlib.md5(payload).hexdigest() != checksum:
+			return None
+		try:
+			value = marshal.loads(payload)
+		except (EOFError, ValueError, TypeError):
+			return None
+		return value if plain_data(value) else None
+
+	def put(self, kind, digest, value):
+		if self.data is None:
+			self.data = {}
+		payload = marshal.dumps(value)
+		self.data[kind] = (digest, payload, hashlib.md5(payload).hexdigest())
+
+	def save(self):
+		with open(self.filename(), "wb") as f:
+			f.write(BAKE_HEADER)
+			f.write(marshal.dumps(self.data or {}))
+
+def always(arg):
+	"""
+	Предикат PredicateDict по умолчанию. Обычная функция, а не лямбда,
+	чтобы существа с интерфейсом можно было передать в другой процесс.
+	"""
+	return True
+
+class PredicateDict(object):
+
+	"""
+	Отдаст только те значения, для которых истинен предикат от 
+	переданного с ключом аргумента
+	"""
+
+	def __init__(self):
+		self.data = {}
+
+	def set(self, key, value, predicate = always):
+		self.data[key] = (predicate, value)
+
+	def get(self, key, arg):
+		entry = self.data[key]
+		if entry[0](arg):
+			return entry[1]
+		else:
+			raise KeyError
+
+	def delete(self, key):
+		self.data.pop(key)
+
+	def keys(self, arg):
+		return [key for key in self.data if self.data[key][0](arg)]
+
+	def values(self, arg):
+		return [self.data[key] for key in self.data if self.data[key][0](arg)]
 
 def translate(start, point, n):
 
@@ -243,17 +589,3 @@ def retrieve_item(container, index):
 		return container.pop(index)
 	else:
 		return container.pop()
-
-def insert_to_sorted(container, value, cmp = lambda x, y : x < y):
-	if len(container) == 0:
-		container.append(value)
-		return
-
-	index = 0
-	while index < len(container) and cmp(container[index], value):
-		index += 1
-
-	if index < len(container):
-		container.insert(index, value)
-	else:
-		container.append(value)
\ No newline at end of file
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from game_levels import *
+
+class OccupiedPortalTest(unittest.TestCase):
+
+	"""
+	Ориентир на графе кластеров занят багом: агент, который сквозь двери
+	идёт к далёкой цели, не должен застревать рядом с ним.
+	"""
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		os.chdir(ROOT)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+
+	def walk(self, start, goal, blocker):
+		room = load_text_campaign()[0]
+		self.assertTrue(room.unit_in_pos(blocker), "на портале должен стоять баг")
+		agent = Owner()
+		agent.soul.control = lazy_agent
+		agent._place(room, start)
+		for i in range(100):
+			step = follow_path(agent, goal, radius = 0, xp = expand_w_doors)
+			if not step:
+				break
+			door = room.object_in_pos(step)
+			if door and door.is_door and door.closed:
+				agent.use(step - agent.position)
+			else:
+				agent.move(step - agent.position)
+		return agent.position
+
+	def test_portal_next_to_agent(self):
+		self.assertEqual(self.walk(Position(13, 16), Position(44, 8), Position(15, 15)), Position(44, 8))
+
+	def test_agent_next_to_occupied_portal(self):
+		self.assertEqual(self.walk(Position(13, 23), Position(46, 9), Position(14, 23)), Position(46, 9))
+
+if __name__ == "__main__":
+	unittest.main()
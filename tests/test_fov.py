@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from game_levels import *
+
+#радиусы обзора существ: тестер и баг
+VIEW_DISTS = (6, 5)
+
+def reference_shadowcast(room, position, view_dist):
+	"""
+	Прежний обзор на дробях, без таблиц и масок: тайл ряда row и колонки col
+	занимает угловой отрезок (col + row) / (2 * row + 1) .. (col + row + 1) / (2 * row + 1),
+	тень ряда добавляется к общей после того, как весь ряд просмотрен.
+	Возвращает множества клеток (x, y): видимые и затенённые.
+	"""
+	visible, shadowed = set([(position.x, position.y)]), set()
+	origin = Position(0, 0)
+	bounds = (min(position.y, view_dist), min(room.width - position.x - 1, view_dist), \
+	          min(room.height - position.y - 1, view_dist), min(position.x, view_dist))
+
+	#отрезок - пара дробей (числитель, знаменатель), сравниваем перекрёстным умножением
+	def less_eq(a, b):
+		return a[0] * b[1] <= b[0] * a[1]
+
+	for n in range(4):
+		shadows = []
+		for row in range(1, bounds[n] + 1):
+			current = []
+			for col in range(max(-bounds[(n + 3) % 4], -row), min(bounds[(n + 1) % 4], row) + 1):
+				if origin.dist(Position(row, col)) > view_dist:
+					continue
+				line = ((col + row, 2 * row + 1), (col + row + 1, 2 * row + 1))
+				pos = translate(position, Position(row, col), n)
+				if any(less_eq(lo, line[0]) and less_eq(line[1], hi) for lo, hi in shadows):
+					shadowed.add((pos.x, pos.y))
+				else:
+					visible.add((pos.x, pos.y))
+				if room.opaque(pos):
+					current.append(line)
+
+			#сливаем касающиеся и пересекающиеся отрезки
+			merged = []
+			for lo, hi in sorted(shadows + current, key = lambda line : line[0][0] / line[0][1]):
+				if merged and less_eq(lo, merged[-1][1]):
+					if not less_eq(hi, merged[-1][1]):
+						merged[-1] = (merged[-1][0], hi)
+				else:
+					merged.append((lo, hi))
+			shadows = merged
+
+	return visible, shadowed
+
+class ShadowcastTest(unittest.TestCase):
+
+	"""
+	Обзор на целых наклонах и его пакетный вариант на numpy должны давать
+	ровно то же, что прежний расчёт на дробях, с любого тайла кампании.
+	"""
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		os.chdir(ROOT)
+		self.rooms = load_text_campaign()
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+
+	def positions(self, room):
+		return [Position(x, y) for y in range(room.height) for x in range(room.width) \
+		        if not room.opaque(Position(x, y))]
+
+	def assertView(self, view, expected, pos):
+		visible, shadowed = view
+		self.assertEqual((set(visible.cells()), set(shadowed.cells())), expected, "обзор с %s" % pos)
+
+	def test_scalar(self):
+		for room in self.rooms:
+			for view_dist in VIEW_DISTS:
+				for pos in self.positions(room):
+					self.assertView(shadowcast(room, pos, view_dist), \
+					                reference_shadowcast(room, pos, view_dist), pos)
+
+	@unittest.skipIf(numpy is None, "нет numpy")
+	def test_batch(self):
+		for room in self.rooms:
+			for view_dist in VIEW_DISTS:
+				positions = self.positions(room)
+				for pos, view in zip(positions, shadowcast_batch(room, positions, view_dist)):
+					self.assertView(view, reference_shadowcast(room, pos, view_dist), pos)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import random
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from game_levels import *
+
+def partition(labels):
+	"""
+	Разметка как разбиение: множество областей, каждая - множество клеток.
+	Сами номера областей у разных разметок свои, сравнивать их незачем.
+	"""
+	groups = {}
+	for cell, label in labels.items():
+		groups.setdefault(label, set()).add(cell)
+	return set(frozenset(group) for group in groups.values())
+
+class LocalRelabelTest(unittest.TestCase):
+
+	"""
+	Разметка, которую правят только вокруг изменившихся клеток, должна
+	совпадать с построенной заново после любой последовательности правок:
+	двери и прочие объекты ставятся и убираются в случайных местах,
+	разрезая и сливая области.
+	"""
+
+	EDITS = 300
+	#после скольких правок в среднем сверяться с новой разметкой
+	CHECK_EVERY = 5
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		os.chdir(ROOT)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+
+	def check(self, room, regions, through_doors):
+		cell = next(iter(regions.labels), (1, 1))
+		regions.label(Position(*cell))
+		fresh = Regions(room, through_doors = through_doors)
+		fresh.label(Position(*cell))
+		self.assertEqual(partition(regions.labels), partition(fresh.labels))
+
+		sizes = {}
+		for label in regions.labels.values():
+			sizes[label] = sizes.get(label, 0) + 1
+		self.assertEqual(sizes, regions.sizes)
+		self.assertEqual(sorted(regions.sizes.values()), sorted(fresh.sizes.values()))
+
+	def edit(self, room, seed):
+		rng = random.Random(seed)
+		free = [Position(x, y) for y in range(room.height) for x in range(room.width) \
+		        if room.walkable(Position(x, y)) and not room.object_in_pos(Position(x, y))]
+		#первая разметка строится целиком, дальше правится по клеткам
+		room.regions.label(free[0])
+		room.door_regions.label(free[0])
+
+		placed = []
+		for i in range(self.EDITS):
+			if placed and rng.random() < 0.45:
+				placed.pop(rng.randrange(len(placed))).__die__()
+			else:
+				pos = rng.choice(free)
+				obj = Door() if rng.random() < 0.5 else Placeable()
+				obj._place(room, pos)
+				if obj.room:
+					placed.append(obj)
+			if rng.random() * self.CHECK_EVERY < 1:
+				self.check(room, room.regions, False)
+				self.check(room, room.door_regions, True)
+		self.check(room, room.regions, False)
+		self.check(room, room.door_regions, True)
+
+	def test_campaign(self):
+		for seed, room in enumerate(load_text_campaign()):
+			with self.subTest(room = seed):
+				self.edit(room, seed)
+
+	def test_office(self):
+		self.edit(generate_office(64, 64, seed = 3), 3)
+
+if __name__ == "__main__":
+	unittest.main()